@@ -1,9 +1,16 @@
 import numpy as np
-import matplotlib.pyplot as plt
+import cv2
+import argparse
 import csv
+import json
 import math
+import os
+
+from collections import OrderedDict
+from multiprocessing import Pool
 
 from PIL import Image
+from tqdm import tqdm
 
 # uses code from here: https://andrewwalker.github.io/statefultransitions/post/gaussian-fields/
 
@@ -14,54 +21,258 @@ def fftIndgen(n):
     b = [-i for i in b]
     return a + b
 
-def gaussian_random_field(Pk = lambda k : k**-3.0, size = (100,100)):
-    def Pk2(kx, ky):
-        if kx == 0 and ky == 0:
-            return 0.0
-        return np.sqrt(Pk(np.sqrt(kx**2 + ky**2)))
-    noise = np.fft.fft2(np.random.normal(size = (size[0], size[1])))
-    amplitude = np.zeros((size[0], size[1]))
-    for i, kx in enumerate(fftIndgen(size[0])):
-        for j, ky in enumerate(fftIndgen(size[1])):
-            amplitude[i, j] = Pk2(kx, ky)
-    return np.fft.ifft2(noise * amplitude)
-
-# specify path to your metadata csv file
-with open('/dataset/patient_data.csv', mode='r') as csv_file:
-  csv_reader = csv.DictReader(csv_file)
-  for row in csv_reader:
-    filename = row['image']
-    filename = filename.replace('.jpg', '.png')
-    val = float(row['dob_norm']) # set to value from your csv
+def frequency_grid(size, dtype=np.float64):
+    ''' radial frequency |k| of every (kx, ky) pair of a size[0] x size[1] spectrum
+    Args:
+        size: (rows, cols) of the field
+        dtype: floating point type of the grid
+    '''
+    kx = np.asarray(fftIndgen(size[0]), dtype=dtype)
+    ky = np.asarray(fftIndgen(size[1]), dtype=dtype)
+    # fftIndgen yields n-1 frequencies for odd n, the missing ones stay at 0 (no power)
+    k = np.zeros((size[0], size[1]), dtype=dtype)
+    k[:len(kx), :len(ky)] = np.sqrt(kx[:, None]**2 + ky[None, :]**2)
+    return k
+
+def power_spectrum(Pk, size, dtype=np.float64):
+    ''' amplitude sqrt(Pk(|k|)) for the whole spectrum at once, 0 at the DC term
+    Args:
+        Pk: power law, evaluated on an array of frequencies
+        size: (rows, cols) of the field
+        dtype: floating point type of the amplitude
+    '''
+    k = frequency_grid(size, dtype)
+    amplitude = np.zeros_like(k)
+    valid = k > 0
+    amplitude[valid] = np.sqrt(Pk(k[valid]))
+    return amplitude
+
+def noise_spectrum(noise, dtype=np.float64):
+    ''' forward transform of the white noise, half spectrum whenever the field can be real '''
+    if noise.shape[0] % 2 or noise.shape[1] % 2:
+        # odd sizes have an asymmetric spectrum (see frequency_grid), keep the complex transform
+        return np.fft.fft2(noise)
+    return np.fft.rfft2(noise.astype(dtype))
+
+def filtered_field(spectrum, amplitude, size, dtype=np.float64):
+    ''' inverse transform of the noise spectrum shaped by the amplitude '''
+    if spectrum.shape[1] == size[1]:
+        out = np.fft.ifft2(spectrum * amplitude)
+        return out.astype(np.result_type(dtype, np.complex64), copy = False)
+    # the amplitude is symmetric in k, so the field is real and the half spectrum is enough
+    out = np.fft.irfft2(spectrum * amplitude[:, :spectrum.shape[1]], s = (size[0], size[1]))
+    return out.astype(dtype, copy = False)
+
+def gaussian_random_field(Pk = lambda k : k**-3.0, size = (100,100), dtype = np.float64):
+    noise = np.random.normal(size = (size[0], size[1]))
+    return filtered_field(noise_spectrum(noise, dtype), power_spectrum(Pk, size, dtype), size, dtype)
+
+class GRFBank():
+    ''' Gaussian random fields of one metadata type, the 8-bit images cached by spectral index
+    Every image of a metadata type is drawn with the same seed, so the noise
+    spectrum is computed once and only the power law changes between images.
+    Args:
+        seed: fixed random seed of the metadata type
+        size: (rows, cols) of the fields
+        dtype: floating point type of the fields
+        decimals: alpha is rounded to this many decimals to form the cache key
+        maxsize: number of greyscale images kept in the cache (least recently used are dropped)
+    '''
+    def __init__(self, seed, size=(480, 640), dtype=np.float64, decimals=6, maxsize=16):
+        self.seed = seed
+        self.size = size
+        self.dtype = dtype
+        self.decimals = decimals
+        self.maxsize = maxsize
+        # same draw as np.random.seed(seed); np.random.normal(size=size)
+        noise = np.random.RandomState(seed).normal(size = (size[0], size[1]))
+        self.spectrum = noise_spectrum(noise, dtype)
+        self.k = frequency_grid(size, dtype)[:, :self.spectrum.shape[1]]
+        self.valid = self.k > 0
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def field(self, alpha):
+        ''' GRF with power spectrum k**alpha '''
+        amplitude = np.zeros_like(self.k)
+        amplitude[self.valid] = np.sqrt(self.k[self.valid]**round(float(alpha), self.decimals))
+        return filtered_field(self.spectrum, amplitude, self.size, self.dtype)
+
+    def grey(self, alpha, cache=True):
+        ''' grf_to_grey of field(alpha), the returned array is shared and read-only
+        Args:
+            cache: keep the image for the next request of alpha, worth it for the few values of a
+                discrete field; continuous fields (e.g. the fractional part of dob) rarely repeat
+        '''
+        key = round(float(alpha), self.decimals)
+        if key in self.cache:
+            self.hits += 1
+            self.cache.move_to_end(key)
+            return self.cache[key]
+
+        self.misses += 1
+        out = grf_to_grey(self.field(key))
+        out.setflags(write=False)
+        if cache:
+            self.cache[key] = out
+            if len(self.cache) > self.maxsize:
+                self.cache.popitem(last=False)
+        return out
+
+def spectral_index(val, pi, discrete):
+    ''' power law exponent of the GRF for one metadata value
+    Args:
+        val: (normalised) metadata value
+        pi: offset of the exponent, 2 or 5 to replicate the GRFs from the paper
+        discrete: the variable only has 2 possible values (e.g. gender)
+    '''
+    if discrete:
+        return -abs(pi + val)
+    # variables that have more than 2 possible values (e.g. dob) use their fractional part
+    pd = math.modf(val)[0]
+    return -abs(pi + pd)
+
+def parse_field(spec):
+    ''' "column:seed:pi:discrete|continuous" -> (column, seed, pi, discrete) '''
+    try:
+        column, seed, pi, kind = spec.rsplit(':', 3)
+        seed, pi = int(seed), float(pi)
+    except ValueError:
+        raise argparse.ArgumentTypeError('expected column:seed:pi:discrete|continuous, got %s' % spec)
+    if kind not in ('discrete', 'continuous'):
+        raise argparse.ArgumentTypeError('field type must be discrete or continuous, got %s' % kind)
+    return column, seed, pi, kind == 'discrete'
+
+def field_dir(save_root, column, pi):
+    return os.path.join(save_root, '%s_grf_i%g' % (column, pi))
+
+_GREY_LUT = None
+
+def grey_lut():
+    ''' 8-bit luminance of the 256 viridis colours, i.e. what plt.imsave followed by
+    PIL convert('L') gives for each colormap index (matplotlib is only needed here, once)
+    '''
+    global _GREY_LUT
+    if _GREY_LUT is None:
+        from matplotlib import colormaps
+        rgb = colormaps['viridis'](np.arange(256), bytes=True)[:, :3]
+        _GREY_LUT = np.asarray(Image.fromarray(rgb[None]).convert('L'))[0]
+    return _GREY_LUT
 
+def grf_to_grey(out):
+    ''' min-max normalise a GRF and map it through the greyscale viridis lookup table '''
+    # same arithmetic as matplotlib's Normalize and Colormap with N=256
+    x = np.array(out, dtype=out.dtype if out.dtype.kind == 'f' else np.float64)
+    vmin, vmax = np.float64(x.min()), np.float64(x.max())
+    if vmin == vmax:
+        x.fill(0)
+    else:
+        x -= vmin
+        x /= (vmax - vmin)
+    x *= 256
+    x[x == 256] = 255
+    return grey_lut()[x.astype(int)]
+
+def save_grf(out, path):
+    # save 8-bit greyscale gaussian random field image
+    save_grey(grf_to_grey(out), path)
+
+def save_grey(grey, path):
+    # save a grf_to_grey image
+    Image.fromarray(grey, mode='L').save(path)
+
+def read_metadata(csv_path, columns, image_column='image'):
+    ''' (grf filename, {column: value}) for every row of the metadata csv '''
+    rows = []
+    with open(csv_path, mode='r') as csv_file:
+        for row in csv.DictReader(csv_file):
+            filename = row[image_column].replace('.jpg', '.png')
+            rows.append((filename, {c: float(row[c]) for c in columns}))
+    return rows
+
+def store_path(save_root, column, pi):
+    ''' uint8 array of all GRFs of a variant, its name -> row index is the .json next to it '''
+    return field_dir(save_root, column, pi) + '.npy'
+
+def create_store(path, names, store_size):
+    ''' allocate the GRF array of a variant and write its name -> row index '''
+    grfs = np.lib.format.open_memmap(path, mode='w+', dtype=np.uint8, shape=(len(names), store_size, store_size))
+    del grfs
+    index = {name.split('.')[0]: row for row, name in enumerate(names)}
+    with open(os.path.splitext(path)[0] + '.json', 'w') as f:
+        json.dump(index, f)
+
+# per-process state of the generation workers
+_worker = {}
+
+def _init_worker(fields, size, save_root, png=True, store_size=0):
+    _worker.clear()
+    _worker.update(fields=fields, size=size, save_root=save_root, png=png, store_size=store_size, banks={}, stores={})
+    if store_size:
+        for column, seed, pi, discrete in fields:
+            _worker['stores'][(column, pi)] = np.load(store_path(save_root, column, pi), mmap_mode='r+')
+
+def _generate(rows):
+    banks, stores, store_size = _worker['banks'], _worker['stores'], _worker['store_size']
+    for row, (filename, values) in rows:
+        for column, seed, pi, discrete in _worker['fields']:
+            if seed not in banks:
+                banks[seed] = GRFBank(seed, size=_worker['size'])
+            grey = banks[seed].grey(spectral_index(values[column], pi, discrete), cache=discrete)
+            if _worker['png']:
+                save_grey(grey, os.path.join(field_dir(_worker['save_root'], column, pi), filename))
+            if store_size:
+                # stored at training resolution, resized the same way as A.Resize in the dataloader
+                stores[(column, pi)][row] = cv2.resize(grey, (store_size, store_size), interpolation=cv2.INTER_LINEAR)
+    for grfs in stores.values():
+        grfs.flush()
+    return len(rows)
+
+def arg_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--csv', type=str, default='/dataset/patient_data.csv', help='path to metadata csv file')
+    parser.add_argument('--image-column', type=str, default='image', help='csv column with the image filename')
     # set a fixed random seed for each metadata type
     # dob seed    = 76539635
     # gender seed = 88118546
     # hdd seed    = 41094303
-    np.random.seed(76539635)
-	
-    # change this to either 2 or 5 to replicate the types of GRFs from the paper
-    pi = 5.0
-    
-    # use this for variables that only have 2 possible values
-    # comment this line out if variables have more than 2 possible values
-    p_spec = -abs(pi + val)
-
-    # use this for variables that have more than 2 possible values (e.g. dob)
-    # comment these 2 lines out if variables have only 2 possible values
-    # pd = math.modf(val)[0]
-    # p_spec = -abs(pi + pd)
-
-    print('processing: ' + filename)
-    print('p_spec: ' + str(p_spec))
-
-    for alpha in [p_spec]:
-      out = gaussian_random_field(Pk = lambda k: k**alpha, size=(480,640))
-
-      # save colour gaussian random field image
-      save_dir = '/dataset/grf/'
-      plt.imsave(save_dir + filename, out.real)
-      
-      # reload image and convert to 8-bit greyscale
-      im = Image.open(save_dir + filename).convert('L')
-      im.save(save_dir + filename)
+    parser.add_argument('--field', nargs='+', type=parse_field, default=[parse_field('dob_norm:76539635:5:continuous')],
+                        help='GRF variants as column:seed:pi:discrete|continuous')
+    parser.add_argument('--save_root', type=str, default='/dataset/', help='variants are saved to save_root/<column>_grf_i<pi>/')
+    parser.add_argument('--size', nargs=2, type=int, default=[480, 640], help='GRF height and width')
+    parser.add_argument('--store-size', type=int, default=0, help='also write save_root/<column>_grf_i<pi>.npy at this (training) size')
+    parser.add_argument('--no-png', action='store_true', help='only write the .npy store, no GRF images')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='# processes, 0 to run in this process')
+    parser.add_argument('--chunksize', type=int, default=64, help='# csv rows per task')
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    opt = arg_parser()
+    size = tuple(opt.size)
+    if opt.no_png and not opt.store_size:
+        raise SystemExit('--no-png needs --store-size, nothing would be written')
+    rows = read_metadata(opt.csv, sorted({f[0] for f in opt.field}), opt.image_column)
+    os.makedirs(opt.save_root, exist_ok=True)
+    for column, seed, pi, discrete in opt.field:
+        if not opt.no_png:
+            os.makedirs(field_dir(opt.save_root, column, pi), exist_ok=True)
+        if opt.store_size:
+            create_store(store_path(opt.save_root, column, pi), [r[0] for r in rows], opt.store_size)
+        print('%s: seed %d, pi %g, %s' % (field_dir(opt.save_root, column, pi), seed, pi, 'discrete' if discrete else 'continuous'))
+
+    rows = list(enumerate(rows))
+    chunks = [rows[i:i + opt.chunksize] for i in range(0, len(rows), opt.chunksize)]
+    initargs = (opt.field, size, opt.save_root, not opt.no_png, opt.store_size)
+    pbar = tqdm(total=len(rows), desc='generating %g GRF variants' % len(opt.field))
+    if opt.workers > 0:
+        with Pool(opt.workers, initializer=_init_worker, initargs=initargs) as pool:
+            for n in pool.imap_unordered(_generate, chunks):
+                pbar.update(n)
+    else:
+        _init_worker(*initargs)
+        for chunk in chunks:
+            pbar.update(_generate(chunk))
+    pbar.close()
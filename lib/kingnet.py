@@ -9,12 +9,7 @@ import torch.nn.functional as F
 import math
 import time
 from collections import OrderedDict
-from .layers import IBN, SwitchNorm2d
-
-
-# %%
-def channel_split(x, split):
-    return torch.split(x, split, dim=1)
+from .layers import IBN, SwitchNorm2d, checkpoint_forward
 
 
 # %%
@@ -153,29 +148,73 @@ class KingBlock(nn.Module):
                 layers_.append(ConvLayer(channel, channel))
                     
         self.layers = nn.ModuleList(layers_)
-        
+        self.use_checkpoint = False # recompute the activations of the block in backward
+        self.build_plan()
+
+    def build_plan(self):
+        """Compile the routing of the block into a static plan: layers_[s] (the block input for s=0,
+        the output of layer s-1 otherwise) is split into growth channel chunks, chunk i goes to the
+        input of layer s+links[s][i]-1, and the block output concatenates layers_[s] for s in
+        concate_out and the last one. Every chunk is copied once, straight into the input buffer of
+        its layer, and every output into its slice of one block output buffer; a layer that takes a
+        single chunk reads it as a view.
+        """
+        n, g = self.n_layers, self.growth
+        # channels of layers_[s], every layer keeps its # channels
+        channels = [self.in_channels] + [len(self.links[i + 1]) * g if i != n - 1 else self.in_channels for i in range(n)]
+        sources = [[] for _ in range(n)] # input of layer L: [(s, start, end)] in concatenation order
+        for s in range(n):
+            for i, start in enumerate(range(0, channels[s], g)):
+                sources[s + self.links[s][i] - 1].append((s, start, min(start + g, channels[s])))
+
+        self.views = {} # layer: (start, end) of the chunk of its own layers_ entry it reads
+        self.in_channels_of = {} # layer: # input channels, of the layers with an input buffer
+        self.writes = [[] for _ in range(n)] # source: [(start, end, layer, offset in its input)]
+        for L, chunks in enumerate(sources):
+            if len(chunks) == 1:
+                self.views[L] = chunks[0][1:]
+                continue
+            offset = 0
+            for src, start, end in chunks:
+                self.writes[src].append((start, end, L, offset))
+                offset += end - start
+            self.in_channels_of[L] = offset
+
+        self.out_slices = {} # layers_ index: (start, end) in the block output
+        offset = 0
+        for i in range(n + 1):
+            if i == n or i in self.concate_out[n]:
+                self.out_slices[i] = (offset, offset + channels[i])
+                offset += channels[i]
+        self.out_channels = offset
+
     def forward(self, x):
-        layers_ = [x]
-        tensors = [[] for i in range(self.n_layers)]
-        for layer in range(len(self.layers)):
-            tins = channel_split(x,self.growth)
-            for i in range(len(tins)):
-                tensors[layer+self.links[layer][i]-1].append(tins[i])
-            if len(tensors[layer])>1:
-                x = torch.cat(tensors[layer], dim=1)
+        if self.use_checkpoint and self.training and torch.is_grad_enabled():
+            return checkpoint_forward(self, self._forward, x)
+        return self._forward(x)
+
+    def _forward(self, x):
+        N, _, H, W = x.size()
+        fmt = torch.channels_last if x.is_contiguous(memory_format=torch.channels_last) and not x.is_contiguous() else torch.contiguous_format
+        empty = lambda c: torch.empty((N, c, H, W), dtype=x.dtype, device=x.device, memory_format=fmt)
+        out = empty(self.out_channels)
+        inputs = {}
+        for s in range(self.n_layers + 1):
+            # x is layers_[s]
+            if s in self.out_slices:
+                start, end = self.out_slices[s]
+                out[:, start:end].copy_(x)
+            if s == self.n_layers:
+                break
+            for start, end, L, offset in self.writes[s]:
+                if L not in inputs:
+                    inputs[L] = empty(self.in_channels_of[L])
+                inputs[L][:, offset:offset + end - start].copy_(x[:, start:end])
+            if s in self.views:
+                start, end = self.views[s]
+                x = self.layers[s](x[:, start:end])
             else:
-                x = tensors[layer][0]
-            x = self.layers[layer](x)
-            
-            layers_.append(x)
-        
-        t = len(layers_)
-        out_ = []
-        for i in range(t):
-            if (i == t-1) or (i in self.concate_out[self.n_layers]):
-                out_.append(layers_[i])
-                
-        out = torch.cat(out_, 1)
+                x = self.layers[s](inputs.pop(s))
         #----------不用改 (do not change)----------
         return out
 
@@ -5,6 +5,7 @@ from mmcv.cnn import ConvModule, NonLocal2d
 
 from einops import rearrange
 from timm.models.layers import DropPath, to_2tuple, trunc_normal_
+from .layers import checkpoint_forward
 import math
 
 # https://github.com/yan-hao-tian/lawin/blob/main/lawin_head.py
@@ -109,6 +110,7 @@ class LawinAttn(NonLocal2d):
         if self.head!=1:
             self.position_mixing = nn.ModuleList([nn.Linear(patch_size*patch_size, patch_size*patch_size) for _ in range(self.head)])
         self.apply(self._init_weights)
+        self.use_checkpoint = False # recompute the attention in backward
 
     def _init_weights(self, m):
         if isinstance(m, nn.Linear):
@@ -126,6 +128,11 @@ class LawinAttn(NonLocal2d):
                 m.bias.data.zero_()
                 
     def forward(self, query, context):
+        if self.use_checkpoint and self.training and torch.is_grad_enabled():
+            return checkpoint_forward(self, self._forward, query, context)
+        return self._forward(query, context)
+
+    def _forward(self, query, context):
         # x: [N, C, H, W]
         
         n = context.size(0)
@@ -143,26 +150,26 @@ class LawinAttn(NonLocal2d):
             context = context.reshape(n, c, h, w)
 
         # g_x: [N, HxW, C]
-        g_x = self.g(context).view(n, self.inter_channels, -1)
+        g_x = self.g(context).reshape(n, self.inter_channels, -1)
         g_x = rearrange(g_x, 'b (h dim) n -> (b h) dim n', h=self.head)
         g_x = g_x.permute(0, 2, 1)
 
         # theta_x: [N, HxW, C], phi_x: [N, C, HxW]
         if self.mode == 'gaussian':
-            theta_x = query.view(n, self.in_channels, -1)
+            theta_x = query.reshape(n, self.in_channels, -1)
             theta_x = theta_x.permute(0, 2, 1)
             if self.sub_sample:
-                phi_x = self.phi(context).view(n, self.in_channels, -1)
+                phi_x = self.phi(context).reshape(n, self.in_channels, -1)
             else:
-                phi_x = context.view(n, self.in_channels, -1)
+                phi_x = context.reshape(n, self.in_channels, -1)
         elif self.mode == 'concatenation':
-            theta_x = self.theta(query).view(n, self.inter_channels, -1, 1)
-            phi_x = self.phi(context).view(n, self.inter_channels, 1, -1)
+            theta_x = self.theta(query).reshape(n, self.inter_channels, -1, 1)
+            phi_x = self.phi(context).reshape(n, self.inter_channels, 1, -1)
         else:
-            theta_x = self.theta(query).view(n, self.inter_channels, -1)
+            theta_x = self.theta(query).reshape(n, self.inter_channels, -1)
             theta_x = rearrange(theta_x, 'b (h dim) n -> (b h) dim n', h=self.head)
             theta_x = theta_x.permute(0, 2, 1)
-            phi_x = self.phi(context).view(n, self.inter_channels, -1)
+            phi_x = self.phi(context).reshape(n, self.inter_channels, -1)
             phi_x = rearrange(phi_x, 'b (h dim) n -> (b h) dim n', h=self.head)
 
 
@@ -1,6 +1,9 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+import torch.utils.checkpoint
+import torch.distributed as dist
+import torch.distributed.nn.functional as dist_fn
 
 
 class IBN(nn.Module):
@@ -37,6 +40,8 @@ class SwitchNorm2d(nn.Module):
         self.eps = eps
         self.momentum = momentum
         self.using_moving_average = using_moving_average
+        self.sync = False  # batch statistics over every process, see convert_sync_norm
+        self.process_group = None
         self.using_bn = using_bn
         self.last_gamma = last_gamma
         self.weight = nn.Parameter(torch.ones(1, num_features, 1, 1))
@@ -71,7 +76,7 @@ class SwitchNorm2d(nn.Module):
     def forward(self, x):
         self._check_input_dim(x)
         N, C, H, W = x.size()
-        x = x.view(N, C, -1)
+        x = x.reshape(N, C, -1) # also for channels_last inputs
         mean_in = x.mean(-1, keepdim=True)
         var_in = x.var(-1, keepdim=True)
 
@@ -81,8 +86,12 @@ class SwitchNorm2d(nn.Module):
 
         if self.using_bn:
             if self.training:
-                mean_bn = mean_in.mean(0, keepdim=True)
-                var_bn = temp.mean(0, keepdim=True) - mean_bn ** 2
+                if self.sync and dist.is_initialized():
+                    (mean_bn, temp_bn), _ = sync_mean([mean_in.sum(0, keepdim=True), temp.sum(0, keepdim=True)], N, self.process_group)
+                    mean_bn, var_bn = mean_bn.to(x.dtype), (temp_bn - mean_bn ** 2).to(x.dtype)
+                else:
+                    mean_bn = mean_in.mean(0, keepdim=True)
+                    var_bn = temp.mean(0, keepdim=True) - mean_bn ** 2
                 if self.using_moving_average:
                     self.running_mean.mul_(self.momentum)
                     self.running_mean.add_((1 - self.momentum) * mean_bn.data)
@@ -110,3 +119,142 @@ class SwitchNorm2d(nn.Module):
         x = x.view(N, C, H, W)
         return x * self.weight + self.bias
 
+
+
+def sync_mean(sums, count, process_group=None):
+    """Means of per-process sums over every process of a group, with a single differentiable
+    all-reduce, so the gradients reach the inputs of every process
+
+    Args:
+        sums (list): tensors summed over the count local samples
+        count (int): # local samples
+        process_group: group to synchronise over, all processes if None
+    Return:
+        list of means (float32), total # samples
+    """
+    sizes = [t.numel() for t in sums]
+    flat = torch.cat([t.reshape(-1).float() for t in sums] + [sums[0].new_full((1,), count, dtype=torch.float32)])
+    flat = dist_fn.all_reduce(flat, group=process_group or dist.group.WORLD)
+    total = flat[-1]
+    return [m.view_as(t) / total for m, t in zip(flat[:-1].split(sizes), sums)], total
+
+
+class SyncBatchNorm2d(nn.BatchNorm2d):
+    """BatchNorm2d with the batch statistics computed over every process while training, on any
+    device; nn.SyncBatchNorm only runs on CUDA tensors, so this one is used on the cpu (gloo)
+
+    Args:
+        process_group: group to synchronise over, all processes if None
+    """
+    def __init__(self, *args, process_group=None, **kwargs):
+        super(SyncBatchNorm2d, self).__init__(*args, **kwargs)
+        self.process_group = process_group
+
+    def forward(self, x):
+        self._check_input_dim(x)
+        if not (self.training and dist.is_initialized()):
+            return super(SyncBatchNorm2d, self).forward(x)
+        N, C, H, W = x.size()
+        xf = x.float()
+        (mean, sqr), n = sync_mean([xf.sum((0, 2, 3)), (xf * xf).sum((0, 2, 3))], N * H * W, self.process_group)
+        var = (sqr - mean ** 2).clamp(min=0)
+        if self.track_running_stats:
+            with torch.no_grad():
+                self.num_batches_tracked.add_(1)
+                factor = 1. / float(self.num_batches_tracked) if self.momentum is None else self.momentum
+                self.running_mean.mul_(1 - factor).add_(factor * mean)
+                self.running_var.mul_(1 - factor).add_(factor * var * n / (n - 1).clamp(min=1))
+        out = (xf - mean.view(1, C, 1, 1)) * torch.rsqrt(var + self.eps).view(1, C, 1, 1)
+        if self.affine:
+            out = out * self.weight.view(1, C, 1, 1) + self.bias.view(1, C, 1, 1)
+        return out.to(x.dtype)
+
+
+def convert_sync_norm(module, process_group=None):
+    """Synchronise the batch statistics of every BatchNorm (also inside IBN) and SwitchNorm
+    layer over the processes of a distributed run: nn.SyncBatchNorm on CUDA, SyncBatchNorm2d
+    otherwise
+
+    Args:
+        module (nn.Module): module to convert, on its training device
+        process_group: group to synchronise over, all processes if None
+    """
+    tensor = next(module.parameters(), None)
+    if tensor is not None and tensor.is_cuda:
+        module = nn.SyncBatchNorm.convert_sync_batchnorm(module, process_group)
+    else:
+        module = _convert_batchnorm(module, process_group)
+    for m in module.modules():
+        if isinstance(m, SwitchNorm2d):
+            m.sync, m.process_group = True, process_group
+    return module
+
+
+def _convert_batchnorm(module, process_group):
+    if type(module) is nn.BatchNorm2d:
+        sync = SyncBatchNorm2d(module.num_features, module.eps, module.momentum, module.affine,
+                               module.track_running_stats, process_group=process_group)
+        if module.affine:
+            sync.weight, sync.bias = module.weight, module.bias
+        if module.track_running_stats:
+            sync.running_mean, sync.running_var = module.running_mean, module.running_var
+            sync.num_batches_tracked = module.num_batches_tracked
+        sync.train(module.training)
+        return sync
+    for name, child in module.named_children():
+        module.add_module(name, _convert_batchnorm(child, process_group))
+    return module
+
+
+class frozen_norm_stats():
+    """Keep the running statistics of every BatchNorm/SwitchNorm layer in a module unchanged,
+    e.g. while activation checkpointing recomputes a forward pass, or for a probe forward
+
+    Args:
+        module (nn.Module): module whose normalisation layers are frozen
+    """
+    def __init__(self, module):
+        self.module = module
+
+    def __enter__(self):
+        self.saved = []
+        for m in self.module.modules():
+            if isinstance(m, nn.modules.batchnorm._BatchNorm) and m.track_running_stats:
+                # running = (1 - momentum) * running + momentum * batch
+                self.saved.append((m, m.momentum, m.num_batches_tracked.clone()))
+                m.momentum = 0.
+            elif isinstance(m, SwitchNorm2d) and m.using_bn:
+                # running = momentum * running + (1 - momentum) * batch, or a plain sum
+                self.saved.append((m, m.momentum, (m.running_mean.clone(), m.running_var.clone())))
+                m.momentum = 1.
+        return self.module
+
+    def __exit__(self, *args):
+        for m, momentum, state in self.saved:
+            m.momentum = momentum
+            if isinstance(m, SwitchNorm2d):
+                m.running_mean.copy_(state[0])
+                m.running_var.copy_(state[1])
+            else:
+                m.num_batches_tracked.copy_(state)
+
+
+def checkpoint_forward(module, function, *inputs):
+    """Run function(*inputs) with activation checkpointing: its activations are recomputed in
+    the backward pass instead of being kept. The normalisation statistics of module are only
+    updated by the first pass, so checkpointing does not change training.
+
+    Args:
+        module (nn.Module): module that function belongs to
+        function: forward function of module
+    """
+    calls = [0]
+
+    def run(*inputs):
+        calls[0] += 1
+        if calls[0] == 1:
+            return function(*inputs)
+        with frozen_norm_stats(module):
+            return function(*inputs)
+
+    return torch.utils.checkpoint.checkpoint(run, *inputs, use_reentrant=False)
@@ -11,12 +11,19 @@ import time
 from tqdm import tqdm
 from utils.utils import AvgMeter, square_unpadding, build_model, save_mask, visualize_mask
 from utils.dataloader import test_dataset
+from utils.device import select_device, autocast, synchronize, to_channels_last
+from utils.compile import setup_compile, compile_module, compile_warmup
 # -
 
 def arg_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument('--arch', type=int, default=53, help='backbone version')
     parser.add_argument('--class-num', type=int, default=1, help='output class')
+    parser.add_argument('--device', type=str, default='', help='cpu, cuda, cuda:1, ...; cuda if available by default')
+    parser.add_argument('--amp', action='store_true', help='infer with mixed precision (float16 autocast on cuda, bfloat16 on the cpu), float32 by default')
+    parser.add_argument('--channels_last', action='store_true', help='NHWC memory layout for the model and images')
+    parser.add_argument('--compile', nargs='?', const='static', default='', choices=['static', 'dynamic'], help='torch.compile the model for the test size (static) or with dynamic shapes')
+    parser.add_argument('--compile_cache', type=str, default='weights/compile_cache', help='directory to keep the compiled kernels in between runs')
     parser.add_argument('--test-size', type=int, default=512, help='training dataset size')
 
     parser.add_argument('--weight', nargs='+', type=str, default='/home/staff/cassidbi/bc/seg/HarDNet/weights/bc_exp/', help='path to model weight')
@@ -26,6 +33,8 @@ def arg_parser():
     parser.add_argument('--data_path', nargs='+', type=str, default='/home/staff/cassidbi/bc/seg/HarDNet/dataset/test/', help='path to testing data')
     
     parser.add_argument('--rect', action='store_true', help='padding the image into rectangle')
+    parser.add_argument('--manifest', type=str, default='', help='JSON file to keep the index of data_path in between runs')
+    parser.add_argument('--stats', type=str, default='', help='dataset mean/std. sidecar written by train.py --stats')
     parser.add_argument('--visualize', action='store_true', help='visualize the ground truth and prediction on original image')
     parser.add_argument('--threshold', type=float,default=0.5, help='threshold for mask')
     
@@ -39,11 +48,11 @@ def test(model, test_data, fold_result, tta, rect, fold, k, visualize, save_path
     vis_path = os.path.join(opt.save_path, 'vis')
     
     for i, (image, name, shape, img) in pbar:
-        image = image.cuda()
+        image = to_channels_last(image.to(device), opt.channels_last)
         
-        torch.cuda.synchronize()
+        synchronize(device)
         start_time = time.perf_counter()
-        with torch.no_grad():
+        with torch.no_grad(), autocast(device, opt.amp):
             output = model(image)
             if tta == 'v':
                 output = (output + tf.vflip(model(tf.vflip(image))))/2
@@ -51,6 +60,7 @@ def test(model, test_data, fold_result, tta, rect, fold, k, visualize, save_path
                 output = (output + tf.hflip(model(tf.hflip(image))))/2
             if tta == 'vh':
                 output = (output + tf.vflip(tf.hflip(model(tf.vflip(tf.hflip(image))))))/2
+        output = output.float()
                 
         if rect:
             output = F.interpolate(output, size=(max(shape), max(shape)), mode='bilinear', align_corners=False)
@@ -61,7 +71,7 @@ def test(model, test_data, fold_result, tta, rect, fold, k, visualize, save_path
         output = nn.Tanh()(output).squeeze().cpu().numpy()
         output = (output - output.min()) / (output.max() - output.min() + 1e-16)
         
-        torch.cuda.synchronize()
+        synchronize(device)
         elapsed_time = time.perf_counter() - start_time
         FPS.update(1/elapsed_time, 1)
         
@@ -88,8 +98,18 @@ if __name__ == '__main__':
     if opt.visualize:
         os.makedirs(os.path.join(opt.save_path, 'vis'), exist_ok=True)
     
-    test_data = test_dataset(opt.data_path, opt.test_size, opt.rect)
-    model = build_model(opt.modelname, opt.class_num, opt.arch)
+    test_data = test_dataset(opt.data_path, opt.test_size, opt.rect, manifest=opt.manifest, stats=opt.stats)
+    device = select_device(opt.device)
+    net = to_channels_last(build_model(opt.modelname, opt.class_num, opt.arch, device), opt.channels_last).eval()
+    model = net
+    if opt.compile:
+        setup_compile(opt.compile_cache)
+        model = compile_module(net, opt.compile)
+        def warmup_step(m, size):
+            image = to_channels_last(torch.zeros(1, 4, size, size, device=device), opt.channels_last)
+            with torch.no_grad(), autocast(device, opt.amp):
+                m(image)
+        compile_warmup(model, [opt.test_size], warmup_step, device)
     
     weightlist = []
     for weight in opt.weight if isinstance(opt.weight, list) else [opt.weight]:
@@ -102,7 +122,7 @@ if __name__ == '__main__':
     fold = len(opt.weight)
     for k, weight in enumerate(opt.weight):
         print('Test %gth weight'%(k+1), weight)
-        model.load_state_dict(torch.load(weight))
-        model.eval()
+        # the compiled model shares the weights of net
+        net.load_state_dict(torch.load(weight, map_location=device))
         fold_result = test(model, test_data, fold_result, opt.tta, opt.rect, fold, k, opt.visualize, opt.save_path, opt.threshold)
 
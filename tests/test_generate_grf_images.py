@@ -0,0 +1,38 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+plt = pytest.importorskip('matplotlib.pyplot')
+from PIL import Image
+
+from generate_grf_images import GRFBank, save_grf
+
+
+def save_grf_matplotlib(out, path):
+    # the write path save_grf replaced: colour image, reloaded and converted to 8-bit greyscale
+    plt.imsave(path, out)
+    im = Image.open(path).convert('L')
+    im.save(path)
+
+
+def fields():
+    for seed in (76539635, 88118546, 41094303):
+        for dtype in (np.float64, np.float32):
+            bank = GRFBank(seed, size=(48, 64), dtype=dtype)
+            for alpha in (-5., -3., -1.5):
+                yield 'seed%d_%s_%g' % (seed, np.dtype(dtype).name, alpha), bank.field(alpha)
+    yield 'constant', np.full((48, 64), 0.25)
+    yield 'zeros', np.zeros((48, 64), dtype=np.float32)
+
+
+@pytest.mark.parametrize('name,out', list(fields()))
+def test_save_grf_matches_matplotlib(tmp_path, name, out):
+    old, new = str(tmp_path / 'old.png'), str(tmp_path / 'new.png')
+    save_grf_matplotlib(out, old)
+    save_grf(out, new)
+    with open(old, 'rb') as f_old, open(new, 'rb') as f_new:
+        assert f_old.read() == f_new.read(), name
@@ -2,11 +2,12 @@
 import torch
 import torch.optim.lr_scheduler as lr_scheduler
 import torch.utils.data as data
-import torch.nn.functional as F
-from torch.cuda import amp
+from torch.nn.parallel import DistributedDataParallel as DDP
 
 import os
+import sys
 import argparse
+import contextlib
 import math
 import random
 import time
@@ -16,13 +17,25 @@ import numpy as np
 import pandas as pd
 
 from tqdm import tqdm
-from utils.utils import AvgMeter, build_model
+from utils.utils import build_model
 from utils.dataloader import create_dataset
 from utils.ema import ModelEMA
-from utils.loss import Lossncriterion, structure_loss
+from utils.loss import Lossncriterion, DeepSupervisionLoss, structure_loss
 from utils.optim import set_optimizer
-from utils.metrics import iou_score
+from utils.metrics import iou_score, iou_per_image, MetricAccumulator
 from utils.dataloader import test_dataset
+from utils.grf import GRFSynthesizer, read_spectral_indices
+from utils.augment import BatchAugment
+from utils.sampler import MultiscaleBatchSampler, ShardSampler, multiscale_sizes
+from utils.memory import set_activation_checkpointing
+from utils.checkpoint import AsyncCheckpointer, latest_checkpoint, clear_checkpoints, load_checkpoint, rng_state, set_rng_state
+from utils.folds import FoldScheduler
+from utils.profiler import StepProfiler, profile_stage
+from utils.compile import setup_compile, compile_module, compile_warmup
+from utils.device import autocast, grad_scaler, memory_reserved, to_channels_last
+from utils.distributed import setup_distributed, unwrap, broadcast, per_rank, of_rank, zero_first, cleanup
+from lib.layers import convert_sync_norm
+from generate_grf_images import parse_field
 
 from collections import OrderedDict
 
@@ -31,24 +44,55 @@ def arg_parser():
     parser = argparse.ArgumentParser()
     # for training
     parser.add_argument('--epoch', type=int, default=60, help='# epoch')
-    parser.add_argument('--batchsize', type=int, default=5, help='batch size')
+    parser.add_argument('--batchsize', type=int, default=5, help='total batch size, split over the processes of a distributed run')
+    parser.add_argument('--accumulate', type=int, default=1, help='# batches to accumulate gradients over per optimizer step')
+    parser.add_argument('--act_budget', type=float, default=0, help='checkpoint activations until a batch needs less than this many GB, 0 to disable')
     parser.add_argument('--kfold', type=int, default=5, help='# fold')
     parser.add_argument('--k', type=int, default=-1, help='specific # fold')
+    parser.add_argument('--fold_workers', type=int, default=1, help='# folds trained at once, in separate processes over the gpus or cpu cores')
+    parser.add_argument('--fold_retries', type=int, default=1, help='# restarts of a failed fold, from its latest checkpoint')
     parser.add_argument('--seed', type=int, help='random seed for split data')
     parser.add_argument('--lr', type=float, default=1e-5, help='learning rate')
     parser.add_argument('--name', type=str, default='exp', help='exp name to annotate this training')
     parser.add_argument('--optimizer', type=str, default='AdamW', help='choose optimizer')
+    parser.add_argument('--val_batchsize', type=int, default=8, help='validation batch size')
+    parser.add_argument('--ema_interval', type=int, default=1, help='# optimizer steps between EMA updates')
+    parser.add_argument('--ema_device', type=str, default='', help='device to keep the EMA model on, e.g. cpu, the training device by default')
+    parser.add_argument('--val_ema', action='store_true', help='also validate and save the EMA model')
+    parser.add_argument('--device', type=str, default='', help='cpu, cuda, cuda:1, ...; cuda if available by default')
+    parser.add_argument('--fp32', action='store_true', help='disable mixed precision (float16 autocast on cuda, bfloat16 on the cpu)')
+    parser.add_argument('--eval_amp', action='store_true', help='also validate with mixed precision, float32 by default')
+    parser.add_argument('--channels_last', action='store_true', help='NHWC memory layout for the model and batches')
+    parser.add_argument('--compile', nargs='?', const='static', default='', choices=['static', 'dynamic'], help='torch.compile the model, loss and EMA step: one graph per multiscale size (static) or one with dynamic shapes')
+    parser.add_argument('--compile_cache', type=str, default='weights/compile_cache', help='directory to keep the compiled kernels in between runs')
+    parser.add_argument('--profile', action='store_true', help='record the wall and device time of every training step stage to <name>_fold-<k>_profile.csv/.json')
+    parser.add_argument('--profile_trace', nargs=2, type=int, help='also capture a torch.profiler trace of the global steps N to M')
+    parser.add_argument('--log_interval', type=int, default=20, help='# steps between metric syncs for the progress bar')
+    parser.add_argument('--loss_weights', nargs=4, type=float, default=[1., 1., 1., 1.], help='weights of the main, deep1, deep2 and boundary losses')
 
     # for data
     parser.add_argument('--dataratio', type=float,default=0.8, help='ratio of data for training/val')
     parser.add_argument('--data_path', nargs='+', type=str, default='dataset/train/', help='path to training data')
     parser.add_argument('--augmentation', action='store_true', help='activate data augmentation')
+    parser.add_argument('--batch_aug', action='store_true', help='run the augmentation on whole batches on the training device')
+    parser.add_argument('--loss_targets', action='store_true', help='derive the loss weight maps and boundary targets in the DataLoader workers (not with --batch_aug)')
+    parser.add_argument('--grf_store', type=str, default='', help='.npy GRF store from generate_grf_images.py --store-size')
+    parser.add_argument('--grf_synth', type=parse_field, help='synthesise the GRF channel on the fly, as column:seed:pi:discrete|continuous')
+    parser.add_argument('--metadata', type=str, default='dataset/patient_data.csv', help='metadata csv for --grf_synth')
+    parser.add_argument('--cache', type=str, default='', help='directory to cache decoded, padded and resized samples in')
+    parser.add_argument('--manifest', type=str, default='', help='JSON file to keep the index of data_path in between runs')
+    parser.add_argument('--stats', type=str, default='', help='JSON sidecar of the dataset mean/std., computed if missing or out of date')
 
     # for model
     parser.add_argument('--class-num', type=int, default=1, help='output class')
     parser.add_argument('--arch', type=int, default=53, help='backbone version')
     parser.add_argument('--trainsize', type=int, default=512, help='img size')
+    parser.add_argument('--multiscale', type=float, default=0.25, help='train at sizes within trainsize * (1 -+ multiscale), 0 to disable')
+    parser.add_argument('--progressive', type=int, default=0, help='# epochs to grow the multiscale sizes from the smallest to the largest')
     parser.add_argument('--weight', type=str, default='', help='path to model weight')
+    parser.add_argument('--resume', nargs='?', const='auto', default='', help='resume from a checkpoint, the latest one of --name if no path is given')
+    parser.add_argument('--run_id', type=str, default='', help='only resume checkpoints of this run, set for its folds by --fold_workers')
+    parser.add_argument('--keep_ckpt', type=int, default=3, help='# full-state checkpoints to keep, 0 to keep all')
     parser.add_argument('--modelname', type=str, default='lawinloss4', help='choose model')
     parser.add_argument('--decoder', type=str, default='lawin', help='choose decoder')
     parser.add_argument('--rect', action='store_true', help='padding the image into rectangle')
@@ -80,133 +124,249 @@ def trainingplot(rec, name):
     
     plt.savefig(name, dpi=300)
 
-def test(model, criterion, test_loader):
-    model.eval()
-    mdice, mwbce, mwiou, omax, omin, miou = AvgMeter(), AvgMeter(), AvgMeter(), AvgMeter(), AvgMeter(), AvgMeter()
+def test(models, criterion, test_loader, opt, grf=None):
+    ''' validate several models (e.g. the live and the EMA model) on the same batches
+    Args:
+        models: {name: model}, the progress bar shows the first one
+        opt: training options (rank, precision, memory format and log interval)
+    Return:
+        {name: (dice, loss, iou)}, averaged per image
+    '''
+    for model in models.values():
+        model.eval()
+    metrics = {k: MetricAccumulator(['dice', 'wbce', 'wiou', 'max', 'min', 'iou']) for k in models}
+    first = next(iter(models))
+    device = next(models[first].parameters()).device
     pbar = enumerate(test_loader)
-    print(('\n' + '%10s' * 6) % ('Dice', 'gpu_mem', 'wbce', 'wiou', 'max', 'min'))
-    pbar = tqdm(pbar, total=len(test_loader))
+    if opt.global_rank in [-1, 0]:
+        print(('\n' + '%10s' * 6) % ('Dice', 'gpu_mem', 'wbce', 'wiou', 'max', 'min'))
+        pbar = tqdm(pbar, total=len(test_loader))
     
     for i, (image, gt, name) in pbar:
-        gt = gt.cuda()
-        image = image.cuda()
-        with torch.no_grad():
-            output = model(image)
-            
-        wbce, wiou = structure_loss(output, gt)
-        dice = criterion.dice_coefficient(output, gt)
-        iou = iou_score(output, gt)
-        
-        mdice.update(dice.item(), 1)
-        mwbce.update(wbce.item(), 1)
-        mwiou.update(wiou.item(), 1)
-        omax.update(output.max().item(), 1)
-        omin.update(output.min().item(), 1)
-        miou.update(iou.item(), 1)
+        gt = gt.to(device)
+        image = image.to(device)
+        if grf is not None:
+            image = grf.fill(image, name)
+        image = to_channels_last(image, opt.channels_last)
+        for k, model in models.items():
+            p = next(model.parameters())
+            with torch.no_grad(), autocast(device, opt.eval_amp and not opt.fp32):
+                # the EMA model may be kept on the cpu
+                output = model(image.to(p.device)).to(device)
+            output = output.float()
+                
+            # per image, as with a batch size of 1
+            wbce, wiou = structure_loss(output, gt)
+            dice = criterion.dice_per_image(output, gt)
+            iou = iou_per_image(output, gt)
+            metrics[k].update(len(image), dice=dice.mean(), wbce=wbce.mean(), wiou=wiou.mean(),
+                              max=output.amax(dim=(1, 2, 3)).mean(), min=output.amin(dim=(1, 2, 3)).mean(), iou=iou.mean())
         
-        mem = '%.3gG' % (torch.cuda.memory_reserved() / 1E9 if torch.cuda.is_available() else 0)
-        s = ('%10.4g' + '%10s' + '%10.4g' * 4) % (mdice.avg, mem, mwbce.avg, mwiou.avg, omax.avg, omin.avg)
-        pbar.set_description(s)
+        if opt.global_rank in [-1, 0] and ((i + 1) % opt.log_interval == 0 or i + 1 == len(test_loader)):
+            # the only host sync of the loop
+            avg = metrics[first].averages()
+            mem = '%.3gG' % memory_reserved(device)
+            s = ('%10.4g' + '%10s' + '%10.4g' * 4) % (avg['dice'], mem, avg['wbce'], avg['wiou'], avg['max'], avg['min'])
+            pbar.set_description(s)
         
-    return mdice.avg, mwbce.avg+mwiou.avg, miou.avg
+    results = {}
+    for k in models:
+        # a distributed validation is sharded over the processes
+        metrics[k].all_reduce(device)
+        avg = metrics[k].averages()
+        results[k] = (avg['dice'], avg['wbce'] + avg['wiou'], avg['iou'])
+    return results
 
-def train(train_loader, model, optimizer, epoch, opt, scaler, ema, criterion):
+def train(train_loader, model, optimizer, epoch, opt, scaler, ema, criterion, grf=None, augment=None, profiler=None):
+    if profiler is not None:
+        profiler.start()
     model.train()
-    loss_record, deep1, deep2, boundary, iou_record, dice_record = AvgMeter(), AvgMeter(), AvgMeter(), AvgMeter(), AvgMeter(), AvgMeter()
+    device = next(model.parameters()).device
+    metrics = MetricAccumulator(['loss', 'deep1', 'deep2', 'boundary', 'iou', 'dice'])
     pbar = enumerate(train_loader)
-    print(('\n' + '%10s' * 6) % ('Epoch', 'gpu_mem', 'loss', 'deep1', 'deep2', 'bound'))
     if opt.global_rank in [-1, 0]:
+        print(('\n' + '%10s' * 6) % ('Epoch', 'gpu_mem', 'loss', 'deep1', 'deep2', 'bound'))
         pbar = tqdm(pbar, total=len(train_loader))
     
-    for i, (images, gts, name) in pbar:
-        images = images.cuda()
-        gts = gts.cuda()
+    for i, batch in pbar:
+        if profiler is not None:
+            profiler.begin()
+        images, gts, name = batch[:3]
+        # loss weight maps and boundary targets from the DataLoader workers, --loss_targets
+        targets = batch[3] if len(batch) > 3 else None
+        with profile_stage(profiler, 'h2d'):
+            images = images.to(device)
+            gts = gts.to(device)
+            if targets is not None:
+                targets = targets.to(device)
+        with profile_stage(profiler, 'augment'):
+            if augment is not None:
+                images, gts = augment(images, gts)
+            if grf is not None:
+                images = grf.fill(images, name)
+            images = to_channels_last(images, opt.channels_last)
 
-        multiscale = 0.25
-        trainsize = random.randrange(int(opt.trainsize * (1 - multiscale)), int(opt.trainsize * (1 + multiscale))) // 64 * 64
-        images = F.interpolate(images, size=(trainsize, trainsize), mode='bilinear', align_corners=False)
-        gts = F.interpolate(gts, size=(trainsize, trainsize), mode='bilinear', align_corners=False)
-        
-        # ---- forward ----
-        with amp.autocast():
-            output = model(images)
-            loss = criterion(output[0], gts)
-            deep_loss = criterion(output[1], gts)
-            deep_loss2 = criterion(output[2], gts)
-            boundary_loss = criterion.boundary_forward(output[3], gts)
-            iou = iou_score(output[0], gts)
-            dice = criterion.dice_coefficient(output[0], gts)
-            
-            scaler.scale(loss).backward(retain_graph=True)
-            scaler.scale(deep_loss).backward(retain_graph = True)
-            scaler.scale(deep_loss2).backward(retain_graph = True)
-            scaler.scale(boundary_loss).backward()
-                
-            loss_record.update(loss.item(), opt.batchsize)
-            deep1.update(deep_loss.item(), opt.batchsize)
-            deep2.update(deep_loss2.item(), opt.batchsize)
-            boundary.update(boundary_loss.item(), opt.batchsize)
-            iou_record.update(iou.item(), opt.batchsize)
-            dice_record.update(dice.item(), opt.batchsize)
+        step = (i + 1) % opt.accumulate == 0 or i + 1 == len(train_loader)
+        # gradients are only all-reduced on the last batch of an accumulation window
+        with model.no_sync() if isinstance(model, DDP) and not step else contextlib.nullcontext():
+            # ---- forward ----
+            with autocast(device, not opt.fp32):
+                with profile_stage(profiler, 'forward'):
+                    output = model(images)
+                total_loss, (loss, deep_loss, deep_loss2, boundary_loss) = criterion(output, gts, targets)
+                with profile_stage(profiler, 'metrics'):
+                    iou = iou_score(output[0], gts)
+                    dice = criterion.criterion.dice_coefficient(output[0], gts)
+
+            # ---- one backward for all terms, averaged over the accumulated batches ----
+            with profile_stage(profiler, 'backward'):
+                window = min(opt.accumulate, len(train_loader) - i // opt.accumulate * opt.accumulate)
+                scaler.scale(total_loss / window).backward()
+        metrics.update(opt.batchsize, loss=loss, deep1=deep_loss, deep2=deep_loss2, boundary=boundary_loss, iou=iou, dice=dice)
 
-        scaler.step(optimizer)
-        scaler.update()
-        optimizer.zero_grad()
-        ema.update(model)
+        # ---- optimizer and EMA step once per accumulation window ----
+        if step:
+            with profile_stage(profiler, 'scaler'):
+                scaler.unscale_(optimizer)
+            with profile_stage(profiler, 'optimizer'):
+                scaler.step(optimizer)
+                optimizer.zero_grad()
+            with profile_stage(profiler, 'scaler'):
+                scaler.update()
+            with profile_stage(profiler, 'ema'):
+                ema.update(unwrap(model))
+        if profiler is not None:
+            profiler.end()
         
         if opt.global_rank in [-1, 0]:
-            mem = '%.3gG' % (torch.cuda.memory_reserved() / 1E9 if torch.cuda.is_available() else 0)  # (GB)
-            s = ('%10s' * 2 + '%10.4g' * 4) % ('%g/%g' % (epoch, opt.epoch - 1), mem, loss_record.avg, deep1.avg, deep2.avg, boundary.avg)
-            pbar.set_description(s)
-            ema.update_attr(model)
+            if (i + 1) % opt.log_interval == 0 or i + 1 == len(train_loader):
+                # the only host sync of the metrics
+                avg = metrics.averages()
+                mem = '%.3gG' % memory_reserved(device)  # (GB)
+                s = ('%10s' * 2 + '%10.4g' * 4) % ('%g/%g' % (epoch, opt.epoch - 1), mem, avg['loss'], avg['deep1'], avg['deep2'], avg['boundary'])
+                pbar.set_description(s)
     
-    return loss_record.avg, deep1.avg, deep2.avg, iou_record.avg, dice_record.avg
-
+    ema.update_attr(unwrap(model))
+    metrics.all_reduce(device)
+    avg = metrics.averages()
+    return avg['loss'], avg['deep1'], avg['deep2'], avg['iou'], avg['dice']
 
 
 if __name__ == '__main__':
     opt = arg_parser()
+    save_path = os.path.join('weights', opt.name)
+    resume = None
+    if opt.resume:
+        ckpt_path = latest_checkpoint(os.path.join(save_path, 'checkpoints'), opt.k if opt.k != -1 else None) if opt.resume == 'auto' else opt.resume
+        if ckpt_path is not None:
+            resume = load_checkpoint(ckpt_path)
+        if resume is not None and opt.run_id and resume.get('run') != opt.run_id:
+            # a fold worker restarted before its first checkpoint of this run, the one found is older
+            print('%s is not from run %s, ignoring it' % (ckpt_path, opt.run_id))
+            resume = ckpt_path = None
+        if ckpt_path is not None:
+            if opt.seed is not None and resume['seed'] != opt.seed:
+                raise SystemExit('%s was trained with --seed %g, not %g' % (ckpt_path, resume['seed'], opt.seed))
+            opt.seed = resume['seed'] # same data split
+            print('resuming fold %g after epoch %g from %s' % (resume['fold'], resume['epoch'], ckpt_path))
+        elif opt.k != -1:
+            # e.g. a fold worker restarted before its first checkpoint
+            print('no checkpoint of fold %g to resume from, starting it' % opt.k)
+        else:
+            raise SystemExit('no checkpoint to resume from in %s' % os.path.join(save_path, 'checkpoints'))
+    opt.global_rank, opt.world_size, opt.local_rank, device = setup_distributed(opt.device)
     if opt.seed == None:
-        opt.seed = np.random.randint(2147483647)
+        # every process needs the same data split
+        opt.seed = broadcast(np.random.randint(2147483647))
         print('You chose seed %g in this training.'%opt.seed)
-    opt.world_size = int(os.environ['WORLD_SIZE']) if 'WORLD_SIZE' in os.environ else 1
-    opt.global_rank = int(os.environ['RANK']) if 'RANK' in os.environ else -1   
+    if not opt.run_id:
+        # continues the run of the checkpoint it resumes
+        opt.run_id = resume.get('run') if resume is not None and resume.get('run') else broadcast('%x' % random.getrandbits(48))
+    if opt.fold_workers > 1 and opt.kfold > 1 and opt.k == -1:
+        assert opt.world_size == 1, '--fold_workers does not run under torchrun'
+        # build the manifest, statistics and sample caches once, then share them with every fold
+        for train_split in (True, False):
+            create_dataset(opt.data_path, opt.trainsize, opt.augmentation, train_split, opt.dataratio, opt.rect, k=0, k_fold=opt.kfold, seed=opt.seed, grf_store=opt.grf_store, grf_synth=bool(opt.grf_synth), cache=opt.cache, batch_augment=opt.batch_aug, manifest=opt.manifest, stats=opt.stats)
+        # with --resume every fold continues from its own latest checkpoint
+        codes = FoldScheduler(sys.argv[1:] + ['--seed', str(opt.seed), '--run_id', opt.run_id], range(opt.kfold), opt.fold_workers, save_path, opt.fold_retries, device.type == 'cuda').run()
+        failed = [k for k, code in codes.items() if code != 0]
+        if len(failed) > 0:
+            raise SystemExit('folds %s failed' % failed)
+        raise SystemExit(0)
+    assert opt.batchsize % opt.world_size == 0, '--batchsize must be a multiple of the # processes'
+    opt.batchsize = opt.batchsize // opt.world_size # per process
+    if opt.compile:
+        # a full and a last, partial batch per multiscale size
+        setup_compile(opt.compile_cache, 2 * len(multiscale_sizes(opt.trainsize, opt.multiscale)) + 2)
+    main = opt.global_rank in [-1, 0]
     
-    logname = opt.name + '_' + time.strftime("%Y%m%d%H%M%S", time.localtime()) + '.log'
-    logging.basicConfig(filename=logname, format='%(asctime)s %(message)s', datefmt='%m/%d/%Y %I:%M:%S %p', level=logging.INFO)
-    logging.info(opt)
-    print('logging at ', logname)
+    if main:
+        logname = opt.name + ('_fold-%d' % opt.k if opt.k != -1 else '') + '_' + time.strftime("%Y%m%d%H%M%S", time.localtime()) + '.log'
+        logging.basicConfig(filename=logname, format='%(asctime)s %(message)s', datefmt='%m/%d/%Y %I:%M:%S %p', level=logging.INFO)
+        logging.info(opt)
+        print('logging at ', logname)
     
-    save_path = os.path.join('weights', opt.name)
     os.makedirs(save_path, exist_ok=True)
+    checkpointer = AsyncCheckpointer(os.path.join(save_path, 'checkpoints'), opt.keep_ckpt) if main else None
+
+    grf = None
+    if opt.grf_synth:
+        column, grf_seed, pi, discrete = opt.grf_synth
+        grf = GRFSynthesizer(grf_seed, read_spectral_indices(opt.metadata, column, pi, discrete)).to(device)
     
     for k in range(opt.kfold):
         if opt.kfold > 1:
             print('%g/%g-fold'%(k+1, opt.kfold))
             if opt.k != -1:
                 k = opt.k
+        if resume is not None and k < resume['fold']:
+            continue
                 
-        train_dataset = create_dataset(opt.data_path, opt.trainsize, opt.augmentation, True, opt.dataratio, opt.rect, k=k, k_fold=opt.kfold, seed=opt.seed)
-        train_loader = data.DataLoader(dataset=train_dataset, batch_size=opt.batchsize, shuffle=True, num_workers=4, pin_memory=True)
+        with zero_first(opt.global_rank): # the manifest, statistics and sample caches are written once
+            train_dataset = create_dataset(opt.data_path, opt.trainsize, opt.augmentation, True, opt.dataratio, opt.rect, k=k, k_fold=opt.kfold, seed=opt.seed, grf_store=opt.grf_store, grf_synth=grf is not None, cache=opt.cache, batch_augment=opt.batch_aug, manifest=opt.manifest, stats=opt.stats, loss_targets=opt.loss_targets)
+        # every process draws the same batch sizes, on its own shard of the data
+        sampler = data.distributed.DistributedSampler(train_dataset, seed=opt.seed + k) if opt.world_size > 1 else data.RandomSampler(train_dataset)
+        train_sampler = MultiscaleBatchSampler(sampler, opt.batchsize, multiscale_sizes(opt.trainsize, opt.multiscale),
+                                               seed=opt.seed + k, progressive=opt.progressive)
+        train_loader = data.DataLoader(dataset=train_dataset, batch_sampler=train_sampler, num_workers=4, pin_memory=True)
+        loss_targets = train_dataset.loss_targets
+        augment = BatchAugment(train_dataset.nom.mean, train_dataset.nom.std, seed=opt.seed + k + 1000003 * max(opt.global_rank, 0)) if train_dataset.batch_augment else None
+        if grf is not None:
+            grf.mean, grf.std = train_dataset.nom.mean[3], train_dataset.nom.std[3]
         del train_dataset
 
-        test_dataset = create_dataset(opt.data_path, opt.trainsize, False, False, opt.dataratio, opt.rect, k=k, k_fold=opt.kfold, seed=opt.seed)
-        test_loader = data.DataLoader(dataset=test_dataset, batch_size=1, shuffle=True, num_workers=4, pin_memory=True)
+        with zero_first(opt.global_rank):
+            test_dataset = create_dataset(opt.data_path, opt.trainsize, False, False, opt.dataratio, opt.rect, k=k, k_fold=opt.kfold, seed=opt.seed, grf_store=opt.grf_store, grf_synth=grf is not None, cache=opt.cache, manifest=opt.manifest, stats=opt.stats)
+        test_sampler = ShardSampler(test_dataset, opt.world_size, opt.global_rank) if opt.world_size > 1 else None
+        test_loader = data.DataLoader(dataset=test_dataset, batch_size=opt.val_batchsize, shuffle=False, sampler=test_sampler, num_workers=4, pin_memory=True)
         del test_dataset
         
-        model = build_model() #opt.modelname, opt.class_num, opt.arch)
+        model = to_channels_last(build_model(device=device), opt.channels_last) #opt.modelname, opt.class_num, opt.arch)
+        if opt.world_size > 1:
+            model = convert_sync_norm(model)
         logging.info(model)
+        if opt.act_budget > 0:
+            size = max(multiscale_sizes(opt.trainsize, opt.multiscale))
+            sample = torch.zeros(1, 4, size, size, device=next(model.parameters()).device)
+            n, estimate = set_activation_checkpointing(model, sample, opt.act_budget * 1E9, opt.batchsize, not opt.fp32)
+            print('activation checkpointing %g modules, ~%.3gG of activations per batch' % (n, estimate / 1E9))
+            del sample
         
         optimizer = set_optimizer(model, opt.optimizer, opt.lr)
         logging.info(optimizer)
         lf = lambda x: ((1.001 + math.cos(x * math.pi / opt.epoch))) #* (1 - 0.1) + 0.1  # cosine
         scheduler = lr_scheduler.LambdaLR(optimizer, lr_lambda=lf)
-        scaler = amp.GradScaler()
-        ema = ModelEMA(model) if opt.global_rank in [-1, 0] else None
-        criterion = Lossncriterion().cuda()
+        scaler = grad_scaler(device, not opt.fp32)
+        criterion = Lossncriterion().to(device)
+        deep_supervision = DeepSupervisionLoss(criterion, opt.loss_weights)
+        profiler = None
+        if opt.profile and main:
+            profiler = StepProfiler(device, opt.profile_trace, opt.name + '_fold-' + str(k) + '_trace.json')
+            deep_supervision.profiler = profiler
         
         if opt.weight != '':
-            model.load_state_dict(torch.load(opt.weight))#, map_location=device))
+            model.load_state_dict(torch.load(opt.weight, map_location=device))
+        ema = ModelEMA(model, compile=bool(opt.compile), interval=opt.ema_interval, device=opt.ema_device or None)
 
         log = OrderedDict([
             ('epoch', []),
@@ -224,12 +384,59 @@ if __name__ == '__main__':
         print('Start training at rank: ', opt.global_rank)
         best = 0
         rec = np.zeros((6, opt.epoch))
-        for epoch in range(opt.epoch):
+        start_epoch = 0
+        if resume is not None and k == resume['fold']:
+            model.load_state_dict(resume['model'])
+            optimizer.load_state_dict(resume['optimizer'])
+            scheduler.load_state_dict(resume['scheduler'])
+            scaler.load_state_dict(resume['scaler'])
+            if resume['ema'] is not None:
+                ema.ema.load_state_dict(resume['ema'])
+                ema.updates = resume['ema_updates']
+            if augment is not None and resume['augment'] is not None:
+                augment.set_state(of_rank(resume['augment'], opt.global_rank))
+            best, rec, log = resume['best'], resume['rec'], resume['log']
+            set_rng_state(of_rank(resume['rng'], opt.global_rank))
+            start_epoch = resume['epoch'] + 1
+            resume = None
+        elif main:
+            # from scratch, checkpoints of this fold left by an earlier run must not replace this run's
+            clear_checkpoints(os.path.join(save_path, 'checkpoints'), k)
+        if opt.world_size > 1:
+            # the classification head of the backbone is not used for segmentation and would never get a gradient
+            for p in model.backbone.base[-1].parameters():
+                p.requires_grad_(False)
+        if opt.compile:
+            model = compile_module(model, opt.compile)
+            deep_supervision = compile_module(deep_supervision, opt.compile)
+            def warmup_step(m, size):
+                images = to_channels_last(torch.zeros(opt.batchsize, 4, size, size, device=device), opt.channels_last)
+                with autocast(device, not opt.fp32):
+                    targets = torch.ones(opt.batchsize, 2, size, size, device=device) if loss_targets else None
+                    total_loss, _ = deep_supervision(m(images), torch.zeros(opt.batchsize, 1, size, size, device=device), targets)
+                total_loss.backward()
+                m.zero_grad(set_to_none=True)
+            # every multiscale size before the first epoch, from the cache if an earlier run compiled it
+            report = compile_warmup(model, multiscale_sizes(opt.trainsize, opt.multiscale), warmup_step, device)
+            logging.info('compile warmup (compile s, eager s/step, compiled s/step): %s' % report)
+        if opt.world_size > 1:
+            # a head whose loss weight is 0 is skipped by DeepSupervisionLoss and gets no gradient
+            model = DDP(model, device_ids=[device] if device.type == 'cuda' else None,
+                        find_unused_parameters=any(w == 0 for w in opt.loss_weights))
+        for epoch in range(start_epoch, opt.epoch):
             optimizer.zero_grad()
-            loss, deep1, deep2, iou, dice = train(train_loader, model, optimizer, epoch, opt, scaler, ema, criterion)
+            train_loader.batch_sampler.set_epoch(epoch)
+            loss, deep1, deep2, iou, dice = train(train_loader, model, optimizer, epoch, opt, scaler, ema, deep_supervision, grf, augment, profiler)
+            if profiler is not None:
+                for row in profiler.summary(epoch):
+                    logging.info('profile %s: %.1f%% of the step, wall %.3g ms (p90 %.3g), device %.3g ms (p90 %.3g)' % (
+                        row['stage'], row['share'] * 100, row['wall_mean'], row['wall_p90'], row['device_mean'], row['device_p90']))
+                profiler.save(opt.name + '_fold-' + str(k) + '_profile')
             scheduler.step()
 
-            val_dice, val_loss, val_iou = test(model, criterion, test_loader)
+            models = {'model': unwrap(model), 'ema': ema.ema} if opt.val_ema else {'model': unwrap(model)}
+            results = test(models, criterion, test_loader, opt, grf)
+            val_dice, val_loss, val_iou = results['model']
             if val_iou > best:
                 best = val_iou
                 # if best > 0.8:
@@ -243,7 +450,6 @@ if __name__ == '__main__':
             rec[4, epoch] = best
             rec[5, epoch] = val_loss
             logging.info('Epoch: %g,mDice: %g,Best mDice: %g,loss: %g,loss2: %g,loss3: %g,lr: %g'%(epoch, val_dice, best, loss, deep1, deep2, scheduler.get_last_lr()[0]))
-            print("best val_iou: ", best)
 
             # save csv log for current epoch
             log['epoch'].append(epoch)
@@ -256,14 +462,41 @@ if __name__ == '__main__':
             log['val_loss'].append(val_loss)
             log['val_dice'].append(val_dice)
             log['val_iou'].append(val_iou)
+            if opt.val_ema:
+                ema_dice, ema_loss, ema_iou = results['ema']
+                for key, v in (('ema_val_loss', ema_loss), ('ema_val_dice', ema_dice), ('ema_val_iou', ema_iou)):
+                    log.setdefault(key, []).append(v)
+
+            # the RNG and augmentation states of every process, the rest is only kept by the first one
+            rng, augment_state = per_rank(rng_state()), per_rank(augment.get_state()) if augment is not None else None
+            if not main:
+                continue
+            print("best val_iou: ", best)
+            if opt.val_ema:
+                print('ema val_dice: %g, val_iou: %g' % (ema_dice, ema_iou))
 
             pd.DataFrame(log).to_csv(opt.name + '_fold-' + str(k) + '_log.csv', index=False)
 
-            torch.save(model.state_dict(), os.path.join(save_path, 'fold-' + str(k) + '_' + '%s_%g,%g_val_iou_0.%g_epoch_%g.pth'%(opt.name, k+1, opt.kfold, int(val_iou*10000), epoch)))
+            checkpointer.write(unwrap(model).state_dict(), os.path.join(save_path, 'fold-' + str(k) + '_' + '%s_%g,%g_val_iou_0.%g_epoch_%g.pth'%(opt.name, k+1, opt.kfold, int(val_iou*10000), epoch)))
+            if opt.val_ema:
+                checkpointer.write(ema.ema.state_dict(), os.path.join(save_path, 'fold-' + str(k) + '_' + '%s_%g,%g_ema_val_iou_0.%g_epoch_%g.pth'%(opt.name, k+1, opt.kfold, int(ema_iou*10000), epoch)))
             # trainingplot(rec, os.path.join(save_path, '%s_%g,%g_val_iou_0.%g_epoch_%g.pdf'%(opt.name, k+1, opt.kfold, int(val_iou*10000), epoch)))
 
+            # everything needed to continue after this epoch, written in the background
+            checkpointer.save({
+                'seed': opt.seed, 'run': opt.run_id, 'fold': k, 'epoch': epoch,
+                'model': unwrap(model).state_dict(), 'optimizer': optimizer.state_dict(),
+                'scheduler': scheduler.state_dict(), 'scaler': scaler.state_dict(),
+                'ema': ema.ema.state_dict(), 'ema_updates': ema.updates,
+                'augment': augment_state,
+                'best': best, 'rec': rec, 'log': log, 'rng': rng,
+            }, k, epoch)
+
         # torch.save(model.state_dict(), os.path.join(save_path, '%s_%g,%g_final_%g.pth'%(opt.name, k+1, opt.kfold, int(best*10000))))
         # trainingplot(rec, os.path.join(save_path, '%s_%g,%g_final_%g.pdf'%(opt.name, k+1, opt.kfold, int(best*10000))))
         
         if opt.k != -1:
-            break
\ No newline at end of file
+            break
+    if main:
+        checkpointer.wait()
+    cleanup()
@@ -0,0 +1,160 @@
+import math
+import torch
+import torch.nn.functional as F
+
+
+class BatchAugment():
+    ''' Batched, seedable version of the training augmentation in create_dataset
+    Runs on whatever device the batch lives on and samples the same parameters per image:
+        OneOf(CenterCrop, RandomCrop) p=0.3, HorizontalFlip p=0.8, VerticalFlip p=0.8,
+        ShiftScaleRotate p=0.5, OneOf(GaussNoise, RandomBrightnessContrast, CLAHE) p=0.5,
+        ColorJitter(brightness=0.5, contrast=0.5) p=0.3
+    The geometric ops are composed into one affine warp per image, applied jointly to
+    image and mask; like in create_dataset the GRF channel is passed through untouched.
+    CLAHE equalises the luma (Y) channel instead of LAB lightness.
+    Args:
+        mean: normalisation mean of the 4 input channels
+        std: normalisation std. of the 4 input channels
+        crop_scale: crop size relative to the image (480 of a 640 padded image)
+        seed: seed of the augmentation random generator
+    '''
+    def __init__(self, mean, std, crop_scale=0.75, seed=None):
+        self.mean = torch.tensor(mean).view(1, -1, 1, 1)
+        self.std = torch.tensor(std).view(1, -1, 1, 1)
+        self.crop_scale = crop_scale
+        self.seed = seed
+        self.generator = None
+        self.state = None
+
+    def _rand(self, n, device, low=0., high=1.):
+        if self.generator is None or self.generator.device != device:
+            self.generator = torch.Generator(device=device)
+            if self.state is not None:
+                self.generator.set_state(self.state)
+                self.state = None
+            elif self.seed is not None:
+                self.generator.manual_seed(self.seed)
+            else:
+                self.generator.seed()
+        return low + (high - low) * torch.rand(n, generator=self.generator, device=device)
+
+    def get_state(self):
+        return self.generator.get_state() if self.generator is not None else None
+
+    def set_state(self, state):
+        ''' restore the generator state of get_state, applied on the next draw '''
+        self.generator = None
+        self.state = state
+
+    def affine(self, n, device):
+        ''' (n, 2, 3) output -> input maps in normalised coordinates for affine_grid '''
+        # crop, the final resize stretches the crop back to full size
+        crop = self._rand(n, device) < 0.3
+        random_crop = self._rand(n, device) < 0.5
+        c = torch.where(crop, self.crop_scale, 1.)
+        o = torch.where((crop & random_crop).unsqueeze(1), self._rand((n, 2), device, -1, 1) * (1 - self.crop_scale), 0.)
+
+        # flips
+        fx = torch.where(self._rand(n, device) < 0.8, -1., 1.)
+        fy = torch.where(self._rand(n, device) < 0.8, -1., 1.)
+
+        # shift scale rotate
+        ssr = self._rand(n, device) < 0.5
+        angle = torch.where(ssr, self._rand(n, device, -45, 45), 0.) * math.pi / 180
+        scale = torch.where(ssr, self._rand(n, device, 0.9, 1.1), 1.)
+        shift = torch.where(ssr.unsqueeze(1), self._rand((n, 2), device, -0.1, 0.1) * 2, 0.)
+
+        # p_in = c * flip(rot(-angle)(p_out - shift) / scale) + o
+        cos, sin = torch.cos(angle), torch.sin(angle)
+        m = torch.stack([torch.stack([cos, sin], -1), torch.stack([-sin, cos], -1)], 1) / scale.view(-1, 1, 1)
+        m = m * (c.view(-1, 1) * torch.stack([fx, fy], -1)).unsqueeze(-1)
+        t = o - torch.bmm(m, shift.unsqueeze(-1)).squeeze(-1)
+        return torch.cat([m, t.unsqueeze(-1)], -1)
+
+    def clahe(self, rgb, clip_limit, grid=8):
+        ''' contrast limited adaptive histogram equalisation of the luma of (n, 3, H, W) images in [0, 255] '''
+        n, _, h, w = rgb.shape
+        y = (0.299 * rgb[:, 0] + 0.587 * rgb[:, 1] + 0.114 * rgb[:, 2]).clamp(0, 255)
+        ph, pw = (grid - h % grid) % grid, (grid - w % grid) % grid
+        yp = F.pad(y.unsqueeze(1), (0, pw, 0, ph), mode='reflect').squeeze(1) if ph or pw else y
+        th, tw = yp.shape[1] // grid, yp.shape[2] // grid
+
+        # per tile histograms
+        bins = yp.round().long()
+        tiles = bins.view(n, grid, th, grid, tw).permute(0, 1, 3, 2, 4).reshape(n, grid * grid, th * tw)
+        offset = (torch.arange(n * grid * grid, device=rgb.device) * 256).view(n, grid * grid, 1)
+        hist = torch.zeros(n * grid * grid * 256, device=rgb.device)
+        hist.scatter_add_(0, (tiles + offset).flatten(), torch.ones(tiles.numel(), device=rgb.device))
+        hist = hist.view(n, grid * grid, 256)
+
+        # clip and redistribute, then the cdf is the lookup table of each tile
+        limit = (clip_limit * th * tw / 256).clamp_min(1).view(n, 1, 1)
+        excess = (hist - limit).clamp_min(0).sum(-1, keepdim=True)
+        hist = hist.minimum(limit) + excess / 256
+        lut = (hist.cumsum(-1) * 255 / (th * tw)).clamp(0, 255).view(n, grid, grid, 256)
+
+        # bilinear interpolation between the luts of the 4 nearest tile centres
+        def neighbours(size, tile):
+            pos = ((torch.arange(size, device=rgb.device) + 0.5) / tile - 0.5).clamp(0, grid - 1)
+            t0 = pos.floor().long()
+            return t0, (t0 + 1).clamp(max=grid - 1), pos - t0
+        y0, y1, wy = neighbours(h, th)
+        x0, x1, wx = neighbours(w, tw)
+        b = torch.arange(n, device=rgb.device).view(n, 1, 1)
+        v = bins[:, :h, :w]
+        wy, wx = wy.view(1, h, 1), wx.view(1, 1, w)
+        top = lut[b, y0.view(1, h, 1), x0.view(1, 1, w), v] * (1 - wx) + lut[b, y0.view(1, h, 1), x1.view(1, 1, w), v] * wx
+        bottom = lut[b, y1.view(1, h, 1), x0.view(1, 1, w), v] * (1 - wx) + lut[b, y1.view(1, h, 1), x1.view(1, 1, w), v] * wx
+        y_eq = top * (1 - wy) + bottom * wy
+        return (rgb + (y_eq - y).unsqueeze(1)).clamp(0, 255)
+
+    def photometric(self, rgb):
+        ''' OneOf(GaussNoise, RandomBrightnessContrast, CLAHE) p=0.5, then ColorJitter p=0.3 '''
+        n, device = rgb.shape[0], rgb.device
+        view = lambda x: x.view(-1, 1, 1, 1)
+        choice = torch.where(self._rand(n, device) < 0.5, (self._rand(n, device) * 3).long().clamp(max=2), -1)
+
+        # GaussNoise(var_limit=(10.0, 50.0)), per channel
+        sigma = self._rand(n, device, 10, 50).sqrt()
+        noise = torch.randn(rgb.shape, generator=self.generator, device=device) * view(sigma)
+        rgb = torch.where(view(choice == 0), (rgb + noise).clamp(0, 255), rgb)
+
+        # RandomBrightnessContrast(brightness_limit=0.2, contrast_limit=0.2, brightness_by_max=True)
+        alpha = self._rand(n, device, 0.8, 1.2)
+        beta = self._rand(n, device, -0.2, 0.2) * 255
+        rgb = torch.where(view(choice == 1), (rgb * view(alpha) + view(beta)).clamp(0, 255), rgb)
+
+        # CLAHE(clip_limit=(1, 4), tile_grid_size=(8, 8))
+        idx = (choice == 2).nonzero().squeeze(1)
+        if len(idx) > 0:
+            rgb = rgb.index_copy(0, idx, self.clahe(rgb[idx], self._rand(len(idx), device, 1, 4)))
+
+        # ColorJitter(brightness=0.5, contrast=0.5), in random order
+        jitter = view(self._rand(n, device) < 0.3)
+        brightness = view(self._rand(n, device, 0.5, 1.5))
+        contrast = view(self._rand(n, device, 0.5, 1.5))
+        brightness_first = view(self._rand(n, device) < 0.5)
+        def adjust_contrast(x):
+            grey = (0.299 * x[:, 0] + 0.587 * x[:, 1] + 0.114 * x[:, 2]).mean(dim=(1, 2)).view(-1, 1, 1, 1)
+            return (x * contrast + grey * (1 - contrast)).clamp(0, 255)
+        bc = adjust_contrast((rgb * brightness).clamp(0, 255))
+        cb = (adjust_contrast(rgb) * brightness).clamp(0, 255)
+        return torch.where(jitter, torch.where(brightness_first, bc, cb), rgb)
+
+    @torch.no_grad()
+    def __call__(self, images, gts):
+        ''' augment and normalise a batch
+        Args:
+            images: (B, 4, H, W) RGB + GRF in [0, 255], as returned by create_dataset(batch_augment=True)
+            gts: (B, 1, H, W) masks in [0, 1]
+        '''
+        images, gts = images.float(), gts.float()
+        n, _, h, w = images.shape
+        grid = F.affine_grid(self.affine(n, images.device), (n, 1, h, w), align_corners=False)
+        rgb = F.grid_sample(images[:, :3], grid, mode='bilinear', padding_mode='reflection', align_corners=False)
+        gts = F.grid_sample(gts, grid, mode='nearest', padding_mode='reflection', align_corners=False)
+        rgb = self.photometric(rgb)
+
+        images = torch.cat([rgb, images[:, 3:]], 1) / 255
+        images = (images - self.mean.to(images)) / self.std.to(images)
+        return images, gts
@@ -0,0 +1,181 @@
+import os
+import json
+import hashlib
+import cv2
+import numpy as np
+import albumentations as A
+
+from multiprocessing import Pool
+from tqdm import tqdm
+from utils.utils import pad_to_square
+
+
+def file_state(path):
+    ''' (size, mtime) of a file, None if it does not exist '''
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return [st.st_size, st.st_mtime_ns]
+
+def file_hash(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+def decode_sample(sample, size, rect):
+    ''' read, pad and resize one (image, mask, grf) triplet
+    Args:
+        sample: (image path, mask path, grf path)
+        size: square size the sample is stored at
+        rect: pad the image to square before resizing
+    Return:
+        image, mask, grf (None if there is no grf image), the hash of every source file and
+        the (height, width) of the padded image before resizing
+    '''
+    hashes, arrays = [], []
+    for path, flag in zip(sample, (cv2.IMREAD_COLOR, cv2.IMREAD_GRAYSCALE, cv2.IMREAD_GRAYSCALE)):
+        if path is None or not os.path.exists(path):
+            hashes.append(None)
+            arrays.append(None)
+            continue
+        with open(path, 'rb') as f:
+            buf = f.read()
+        hashes.append(hashlib.sha1(buf).hexdigest())
+        arrays.append(cv2.imdecode(np.frombuffer(buf, np.uint8), flag))
+
+    image, gt, grf = arrays
+    image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+    if rect:
+        image, gt = pad_to_square(image, gt)
+    shape = list(image.shape[:2])
+    total = A.Resize(size, size)(image=image, mask=gt)
+    if grf is not None:
+        grf = A.Resize(size, size)(image=grf)['image']
+    return total['image'], total['mask'], grf, hashes, shape
+
+def _decode(args):
+    return decode_sample(*args)
+
+
+class SampleCache():
+    ''' padded and resized uint8 image/mask/GRF samples in sharded memory-mapped .npy files
+    manifest.json maps every image path to its (shard, row) and the state of its source
+    files, entries are rebuilt when a source file changes (same size/mtime, or same content hash)
+    Args:
+        cache_dir: directory of the shards and the manifest
+        size: square size the samples are stored at
+        rect: samples are padded to square before resizing
+        shard_size: # samples per shard
+        workers: # processes used to decode samples
+    '''
+    version = 2
+
+    def __init__(self, cache_dir, size, rect, shard_size=1024, workers=4):
+        self.cache_dir = cache_dir
+        self.size = size
+        self.rect = rect
+        self.shard_size = shard_size
+        self.workers = workers
+        self.shards = {}
+        os.makedirs(cache_dir, exist_ok=True)
+
+        self.manifest = {'version': self.version, 'size': size, 'rect': rect, 'shards': [], 'samples': {}}
+        path = os.path.join(cache_dir, 'manifest.json')
+        if os.path.exists(path):
+            with open(path) as f:
+                manifest = json.load(f)
+            if all(manifest.get(k) == self.manifest[k] for k in ('version', 'size', 'rect')):
+                self.manifest = manifest
+            else:
+                print('cache %s was built with other settings, rebuilding' % cache_dir)
+
+    def _shard_path(self, shard, kind):
+        return os.path.join(self.cache_dir, 'shard_%03d_%s.npy' % (shard, kind))
+
+    def _changed(self, entry, sample):
+        ''' whether any source of a cached entry changed, refreshes the stored file states '''
+        changed = False
+        for i, path in enumerate(sample):
+            state = file_state(path) if path is not None else None
+            if state == entry['states'][i]:
+                continue
+            if state is None or entry['states'][i] is None or file_hash(path) != entry['hashes'][i]:
+                changed = True
+            entry['states'][i] = state
+        return changed
+
+    def sync(self, samples):
+        ''' make sure every (image, mask, grf) triplet in samples is cached and up to date '''
+        todo, slots = [], []
+        entries = self.manifest['samples']
+        for sample in samples:
+            entry = entries.get(sample[0])
+            if entry is None or entry['sources'] != list(sample):
+                todo.append(sample)
+                slots.append(None)
+            elif self._changed(entry, sample):
+                todo.append(sample)
+                slots.append((entry['shard'], entry['row']))
+
+        # new samples go to new shards, changed ones are rewritten in place
+        new = [i for i, slot in enumerate(slots) if slot is None]
+        for start in range(0, len(new), self.shard_size):
+            shard = len(self.manifest['shards'])
+            length = len(new[start:start + self.shard_size])
+            self.manifest['shards'].append(length)
+            np.lib.format.open_memmap(self._shard_path(shard, 'image'), 'w+', np.uint8, (length, self.size, self.size, 3))
+            np.lib.format.open_memmap(self._shard_path(shard, 'mask'), 'w+', np.uint8, (length, self.size, self.size))
+            np.lib.format.open_memmap(self._shard_path(shard, 'grf'), 'w+', np.uint8, (length, self.size, self.size))
+            for row, i in enumerate(new[start:start + self.shard_size]):
+                slots[i] = (shard, row)
+
+        if len(todo) > 0:
+            print('caching %g samples in %s' % (len(todo), self.cache_dir))
+            self.shards = {}
+            shards = {}
+            args = [(sample, self.size, self.rect) for sample in todo]
+            pool = Pool(self.workers) if self.workers > 0 else None
+            results = pool.imap(_decode, args, chunksize=8) if pool is not None else map(_decode, args)
+            try:
+                for sample, (shard, row), (image, gt, grf, hashes, shape) in tqdm(zip(todo, slots, results), total=len(todo)):
+                    if shard not in shards:
+                        shards[shard] = [np.load(self._shard_path(shard, kind), mmap_mode='r+') for kind in ('image', 'mask', 'grf')]
+                    shards[shard][0][row] = image
+                    shards[shard][1][row] = gt
+                    shards[shard][2][row] = grf if grf is not None else 0
+                    entries[sample[0]] = {'shard': shard, 'row': row, 'grf': grf is not None, 'sources': list(sample), 'shape': shape,
+                                          'states': [file_state(p) if p is not None else None for p in sample], 'hashes': hashes}
+            finally:
+                if pool is not None:
+                    pool.close()
+                    pool.join()
+            for arrays in shards.values():
+                for a in arrays:
+                    a.flush()
+        self._save()
+
+    def _save(self):
+        path = os.path.join(self.cache_dir, 'manifest.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self.manifest, f)
+        os.replace(path + '.tmp', path)
+
+    def __getitem__(self, image_path):
+        ''' image, mask and grf (None if there was no grf image) of a cached sample, as read-only views '''
+        entry = self.manifest['samples'][image_path]
+        shard, row = entry['shard'], entry['row']
+        if shard not in self.shards:
+            # mapped lazily so that every DataLoader worker opens the shards itself
+            self.shards[shard] = [np.load(self._shard_path(shard, kind), mmap_mode='r') for kind in ('image', 'mask', 'grf')]
+        image, gt, grf = self.shards[shard]
+        return image[row], gt[row], grf[row] if entry['grf'] else None
+
+    def source_shape(self, image_path):
+        ''' (height, width) of a cached sample before it was resized, after padding with rect '''
+        return tuple(self.manifest['samples'][image_path]['shape'])
+
+    def __getstate__(self):
+        # never pickle the mapped shards into the workers
+        state = self.__dict__.copy()
+        state['shards'] = {}
+        return state
@@ -0,0 +1,108 @@
+import os
+import re
+import random
+import numpy as np
+import torch
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+CKPT_PATTERN = re.compile(r'fold-(\d+)_epoch-(\d+)\.ckpt$')
+
+
+def to_cpu(obj):
+    ''' copy of a (nested) state with every tensor on the cpu, safe to write while training goes on '''
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, to_cpu(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(v) for v in obj)
+    return obj
+
+def rng_state():
+    state = {'python': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+def checkpoints(save_dir, fold=None):
+    ''' (fold, epoch, path) of the checkpoints in save_dir (of one fold if given), oldest first '''
+    found = []
+    if os.path.isdir(save_dir):
+        for f in os.listdir(save_dir):
+            m = CKPT_PATTERN.match(f)
+            if m and (fold is None or int(m.group(1)) == fold):
+                found.append((int(m.group(1)), int(m.group(2)), os.path.join(save_dir, f)))
+    return sorted(found)
+
+def load_checkpoint(path):
+    # the state holds numpy RNG states and the log next to the tensors
+    return torch.load(path, map_location='cpu', weights_only=False)
+
+def latest_checkpoint(save_dir, fold=None):
+    ''' most recently written checkpoint (of one fold if given); by mtime, so across folds it is
+    the one of the fold that was trained last '''
+    found = checkpoints(save_dir, fold)
+    return max(found, key=lambda f: os.stat(f[2]).st_mtime_ns)[2] if len(found) > 0 else None
+
+def clear_checkpoints(save_dir, fold):
+    ''' remove the checkpoints of a fold, e.g. ones an earlier run with the same name left behind
+    when the fold starts from scratch, they would otherwise win the rotation and --resume '''
+    for _, _, path in checkpoints(save_dir, fold):
+        os.remove(path)
+
+
+class AsyncCheckpointer():
+    ''' writes training checkpoints from a background thread
+    The state is copied to the cpu on the calling thread, so training can go on while it is
+    written; files are written to a temporary name and renamed, so a preempted write never
+    leaves a truncated checkpoint behind.
+    Args:
+        save_dir: directory of the fold-<k>_epoch-<e>.ckpt files
+        keep: # most recent checkpoints to keep, 0 to keep all of them
+    '''
+    def __init__(self, save_dir, keep=3):
+        self.save_dir = save_dir
+        self.keep = keep
+        self.pool = ThreadPoolExecutor(max_workers=1)
+        self.pending = []
+        os.makedirs(save_dir, exist_ok=True)
+
+    def _write(self, state, path, rotate):
+        torch.save(state, path + '.tmp')
+        os.replace(path + '.tmp', path)
+        if rotate is not None and self.keep > 0:
+            # per fold, folds may be trained concurrently (utils/folds.py)
+            for _, _, old in checkpoints(self.save_dir, rotate)[:-self.keep]:
+                os.remove(old)
+        return path
+
+    def _check(self):
+        # raise errors of finished writes here rather than losing them
+        for future in [f for f in self.pending if f.done()]:
+            future.result()
+            self.pending.remove(future)
+
+    def write(self, state, path, rotate=None):
+        ''' write any state (e.g. a state_dict) to path in the background, then drop the oldest
+        checkpoints of fold rotate if given '''
+        self._check()
+        self.pending.append(self.pool.submit(self._write, to_cpu(state), path, rotate))
+
+    def save(self, state, fold, epoch):
+        ''' write the full training state of an epoch and drop the oldest checkpoints '''
+        self.write(state, os.path.join(self.save_dir, 'fold-%d_epoch-%03d.ckpt' % (fold, epoch)), rotate=fold)
+
+    def wait(self):
+        ''' block until every write is done '''
+        for future in self.pending:
+            future.result()
+        self.pending = []
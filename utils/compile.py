@@ -0,0 +1,67 @@
+import os
+import time
+import torch
+import torch._dynamo
+import torch._inductor.config
+
+from utils.device import synchronize
+
+
+def setup_compile(cache_dir='', graphs=8):
+    ''' keep the inductor kernels and FX graphs of torch.compile in cache_dir, so later runs and
+    folds load them instead of compiling again
+    Args:
+        cache_dir: cache directory, the default per-user temporary one if empty
+        graphs: # graphs a compiled function may keep, e.g. one per multiscale size
+    '''
+    if cache_dir:
+        cache_dir = os.path.abspath(cache_dir)
+        os.makedirs(cache_dir, exist_ok=True)
+        os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR', cache_dir)
+        os.environ.setdefault('TRITON_CACHE_DIR', os.path.join(cache_dir, 'triton'))
+    if hasattr(torch._inductor.config, 'fx_graph_cache'):  # not in torch 2.0
+        torch._inductor.config.fx_graph_cache = True
+    torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit, graphs)
+
+def compile_module(module, mode='static'):
+    ''' torch.compile a module or function
+    Args:
+        mode: static to compile one graph per input shape, dynamic for a single graph with symbolic sizes
+    '''
+    return torch.compile(module, dynamic=mode == 'dynamic')
+
+def _timed(step, module, size, device):
+    synchronize(device)
+    start = time.perf_counter()
+    step(module, size)
+    synchronize(device)
+    return time.perf_counter() - start
+
+def compile_warmup(model, sizes, step, device, runs=3):
+    ''' compile a model for every input size before training starts and time it against eager mode
+    The state_dict (e.g. running norm statistics) of the model is restored afterwards.
+    Args:
+        model: module returned by compile_module
+        sizes: input sizes to compile for
+        step: function(module, size) running one training or inference step at size
+        device: device of the model
+        runs: # timed steps per size and mode
+    Return:
+        {size: (compile seconds, eager seconds per step, compiled seconds per step)}
+    '''
+    eager = model._orig_mod
+    state = {k: v.clone() for k, v in eager.state_dict().items()}
+    report = {}
+    # the dropout of the warmup steps must not change the random state of training
+    with torch.random.fork_rng(devices=[device] if device.type == 'cuda' else []):
+        try:
+            for size in sizes:
+                first = _timed(step, model, size, device)
+                _timed(step, eager, size, device)
+                t_eager = min(_timed(step, eager, size, device) for _ in range(runs))
+                t_compiled = min(_timed(step, model, size, device) for _ in range(runs))
+                report[size] = (first, t_eager, t_compiled)
+                print('compiled size %g in %.1fs, %.4gs -> %.4gs per step (%.2fx)' % (size, first, t_eager, t_compiled, t_eager / t_compiled))
+        finally:
+            eager.load_state_dict(state)
+    return report
@@ -3,13 +3,16 @@ import torch.utils.data as data
 import torchvision.transforms as transforms
 import random
 import os
-import glob
+import json
 import cv2
 import numpy as np
 import albumentations as A
 from albumentations.pytorch import ToTensorV2
-from utils.utils import square_padding
-from pathlib import Path
+from utils.utils import square_padding, pad_to_square
+from utils.cache import SampleCache
+from utils.manifest import DatasetManifest, grf_path
+from utils.stats import DEFAULT_MEAN, DEFAULT_STD, dataset_stats, load_stats
+from utils.targets import loss_targets
 from PIL import Image
 
 
@@ -22,22 +25,9 @@ def calculatemns(img_list, size, rect):
         size: target size in training
         rect: padding to rect or not
     '''
-    mean = 0.
-    std = 0.
-    for name in img_list:
-        image = Image.open(name).convert('RGB')
-        w, h = image.size
-        if rect:
-            image = square_padding(image, w, h)
-        
-        image = transforms.Resize((size, size))(transforms.ToTensor()(image))
-        image = image.flatten(1)
-        mean += image.mean(1)
-        std += image.std(1)
-
-    mean /= len(img_list)
-    std /= len(img_list)
-    return mean, std
+    samples = [{'stem': name.split(os.sep)[-1].split('.')[0], 'image': name, 'grf': None} for name in img_list]
+    _, mean, std = dataset_stats(samples, size, rect)
+    return torch.tensor(mean[:3]).float(), torch.tensor(std[:3]).float()
 
 
 def split_data(length, ratio, k=0, seed=7414, k_fold=1):
@@ -56,10 +46,35 @@ def split_data(length, ratio, k=0, seed=7414, k_fold=1):
     else:
         val_idx = val_idx[(length//k_fold)*k: (length//k_fold)*(k+1)]
     
-    train_idx = [x for x in range(length) if x not in val_idx]
+    val_set = set(val_idx)
+    train_idx = [x for x in range(length) if x not in val_set]
     return train_idx, val_idx
 
 
+class GRFStore():
+    ''' read-only view of the GRF array written by generate_grf_images.py --store-size
+    Args:
+        path: path to the .npy file, its name -> row index is the .json next to it
+    '''
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.splitext(path)[0] + '.json') as f:
+            self.index = json.load(f)
+        self.grfs = None
+
+    def __getitem__(self, name):
+        if self.grfs is None:
+            # mapped lazily so that every DataLoader worker opens the file itself
+            self.grfs = np.load(self.path, mmap_mode='r')
+        return self.grfs[self.index[name]]
+
+    def __getstate__(self):
+        # never pickle the mapped array into the workers
+        state = self.__dict__.copy()
+        state['grfs'] = None
+        return state
+
+
 # -
 
 class create_dataset(data.Dataset):
@@ -74,9 +89,21 @@ class create_dataset(data.Dataset):
         k: # fold in k-fold
         k_fold: # fold for cross-validation
         seed: seed for reproducing the random result
+        grf_store: .npy GRF store to read the GRF channel from instead of the /grf/ images
+        grf_synth: leave the GRF channel zeroed, it is synthesised on the batch (utils/grf.py)
+        cache: directory of a SampleCache holding the decoded, padded and resized samples
+        batch_augment: return un-augmented, un-normalised uint8 samples for utils.augment.BatchAugment
+        manifest: JSON file to keep the index of data_path in (see utils/manifest.py)
+        stats: JSON sidecar with the mean/std. of all of data_path, computed if missing or out of date
+        loss_targets: also return the loss weight map and boundary target of every mask (utils/targets.py),
+            derived in the DataLoader workers; not with batch_augment, that changes the masks on the device
     '''
-    def __init__(self, data_path, trainsize, augmentations, train=True, train_ratio=0.8, rect=False, k=0, k_fold=1, seed=None):
+    def __init__(self, data_path, trainsize, augmentations, train=True, train_ratio=0.8, rect=False, k=0, k_fold=1, seed=None, grf_store=None, grf_synth=False, cache=None, batch_augment=False, manifest=None, stats=None, loss_targets=False):
         self.trainsize = trainsize
+        self.batch_augment = batch_augment and augmentations
+        self.loss_targets = loss_targets and not self.batch_augment
+        self.grf_store = GRFStore(grf_store) if grf_store else None
+        self.grf_synth = grf_synth
         self.augmentations = augmentations
         self.ratio = train_ratio
         self.rect = rect
@@ -85,48 +112,59 @@ class create_dataset(data.Dataset):
             We assert that your folder of images/masks is named by "images"/"masks"
             and their type are .jpg or .png
             '''
-            f = []
-            for p in data_path if isinstance(data_path, list) else [data_path]:
-                p = Path(p)
-                f += glob.glob(str(p / '**' / '*.*'), recursive=True)
-
-            self.images = sorted([x for x in f if ('images' in x) and (x.endswith('.jpg') or x.endswith('.png'))])
-            self.gts = sorted([x for x in f if ('masks' in x) and (x.endswith('.jpg') or x.endswith('.png'))])
-            length = len(self.images)
+            samples = all_samples = DatasetManifest(data_path, manifest).paired()
+            length = len(samples)
             
-            #mean, std = calculatemns(self.images, self.trainsize, self.rect)
-            #print('mean:', mean, ' std:', std)
-            mean, std = ([0.485, 0.456, 0.406, 0.1055],[0.229, 0.224, 0.225, 0.1647]) # ImageNet RGB + dataset eY
             train_idx, val_idx = split_data(length, self.ratio, k=k, seed=seed, k_fold=k_fold)
             
+            # samples are sorted by image path and keep that order
             if train:
                 if self.ratio != 1:
-                    self.images = sorted([self.images[idx] for idx in train_idx])
-                    self.gts = sorted([self.gts[idx] for idx in train_idx])
-                
-                for i in range(len(self.images)):
-                    assert self.images[i].split(os.sep)[-1].split('.')[0] == self.gts[i].split(os.sep)[-1].split('.')[0]
-                print('load %g training data from %g images in %s'%(len(self.images), length, data_path))
+                    samples = [samples[idx] for idx in train_idx]
+                print('load %g training data from %g images in %s'%(len(samples), length, data_path))
             
             else:
                 if self.ratio != 0:
-                    self.images = sorted([self.images[idx] for idx in val_idx])
-                    self.gts = sorted([self.gts[idx] for idx in val_idx])
-                
-                for i in range(len(self.images)):
-                    assert self.images[i].split(os.sep)[-1].split('.')[0] == self.gts[i].split(os.sep)[-1].split('.')[0]
-                print('load %g validation data from %g images in %s'%(len(self.images), length, data_path))
+                    samples = [samples[idx] for idx in sorted(val_idx)]
+                print('load %g validation data from %g images in %s'%(len(samples), length, data_path))
         
         except Exception as e:
             raise Exception('Error loading data from %s: %s\n' % (data_path, e))
         
+        mean, std = DEFAULT_MEAN, DEFAULT_STD
+        if stats:
+            # over all samples, so that every fold shares the sidecar
+            mean, std = load_stats(stats, all_samples, self.trainsize, self.rect, grf_store)
+            print('mean:', mean, ' std:', std)
+
+        self.samples = samples
+        self.images = [s['image'] for s in samples]
+        self.gts = [s['mask'] for s in samples]
         self.size = len(self.images)
+        self.cache = None
+        if cache:
+            self.cache = SampleCache(cache, self.trainsize, self.rect)
+            self.cache.sync([(s['image'], s['mask'], s['grf']) for s in self.samples])
+
         if self.augmentations == True:
             print("data augmentation 2")
-            self.transform = A.Compose([
+            self.transform = self.augmentation(480, 480)
+            self.transforms = {}
+            self.jitter = A.ColorJitter(brightness=0.5, contrast=0.5, saturation=0, hue=0, p=0.3)
+   
+        else:
+            print("no data augmentation")
+            self.transform = A.Compose([A.Resize(self.trainsize, self.trainsize)])
+        self.resizes = {self.trainsize: A.Resize(self.trainsize, self.trainsize)}
+        self.nom = transforms.Normalize(mean, std)
+        self.totensor = A.Compose([ToTensorV2()])
+
+    def augmentation(self, crop_h, crop_w):
+        ''' per-sample augmentation, cropping crop_h x crop_w pixels '''
+        return A.Compose([
                 A.OneOf([
-                    A.CenterCrop(480, 480, p=1),
-                    A.RandomCrop(480, 480, p=1),
+                    A.CenterCrop(crop_h, crop_w, p=1),
+                    A.RandomCrop(crop_h, crop_w, p=1),
                     # A.RandomRotate90(p=1)
                 ], p=0.3),
                 A.HorizontalFlip(p=0.8),
@@ -140,72 +178,99 @@ class create_dataset(data.Dataset):
                     A.CLAHE(p=1),
                 ], p=0.5)
             ])
-   
-        else:
-            print("no data augmentation")
-            self.transform = A.Compose([A.Resize(self.trainsize, self.trainsize)])
-        self.nom = transforms.Normalize(mean, std)
-        self.totensor = A.Compose([ToTensorV2()])
+
+    def cached_transform(self, image_path):
+        ''' augmentation of a cached sample, its crop scaled to the cache size so it covers the same
+        part of the image as the 480 px crop of the full resolution sample '''
+        h, w = self.cache.source_shape(image_path)
+        crop = (min(round(480 * self.trainsize / h), self.trainsize), min(round(480 * self.trainsize / w), self.trainsize))
+        if crop not in self.transforms:
+            self.transforms[crop] = self.augmentation(*crop)
+        return self.transforms[crop]
+
+    def resize(self, size):
+        if size not in self.resizes:
+            self.resizes[size] = A.Resize(size, size)
+        return self.resizes[size]
         
     def __getitem__(self, index):
         # https://github.com/pytorch/vision/issues/9
         seed = np.random.randint(2147483647) # make a seed with numpy generator  #21474
 
-        # Read an image with OpenCV
-        image = cv2.imread(self.images[index])
-        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-        gt = cv2.imread(self.gts[index], cv2.IMREAD_GRAYSCALE)
+        # (index, size) from MultiscaleBatchSampler loads the sample at that size
+        index, size = index if isinstance(index, tuple) else (index, self.trainsize)
         name = self.gts[index]
-        
-        if self.rect:
-            if image.shape[0] > image.shape[1]:
-                total = A.PadIfNeeded(p=1, min_height=image.shape[0], min_width=image.shape[0], border_mode=cv2.BORDER_CONSTANT, value=0, mask_value=0)(image=image, mask=gt)
-                image = total['image']
-                gt = total['mask']
-                assert image.shape[0] == image.shape[1], '1, %s, %g/%g' % (self.images[index], image.shape[0], image.shape[1])
-            elif image.shape[0] < image.shape[1]:
-                total = A.PadIfNeeded(p=1, min_height=image.shape[1], min_width=image.shape[1], border_mode=cv2.BORDER_CONSTANT, value=0, mask_value=0)(image=image, mask=gt)
-                image = total['image']
-                gt = total['mask']
-                assert image.shape[0] == image.shape[1], '2, %s, %g/%g' % (self.images[index], image.shape[0], image.shape[1])
-            else:
-                pass
+        grf = None
+        if self.cache is not None:
+            # decoded, padded and resized when the cache was built
+            image, gt, grf = self.cache[self.images[index]]
+            gt = gt.copy() # the cache is mapped read-only
+            if self.augmentations and not self.batch_augment:
+                image = image.copy()
+        else:
+            # Read an image with OpenCV
+            image = cv2.imread(self.images[index])
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+            gt = cv2.imread(self.gts[index], cv2.IMREAD_GRAYSCALE)
+
+            if self.rect:
+                image, gt = pad_to_square(image, gt)
+                assert image.shape[0] == image.shape[1], '%s, %g/%g' % (self.images[index], image.shape[0], image.shape[1])
 
-        if self.augmentations:
-            total = self.transform(image=image, mask=gt)
+        if self.augmentations and not self.batch_augment:
+            transform = self.cached_transform(self.images[index]) if self.cache is not None else self.transform
+            total = transform(image=image, mask=gt)
             image = total["image"]
             gt = total['mask']
-            total = A.ColorJitter(brightness=0.5, contrast=0.5, saturation=0, hue=0, p=0.3)(image=image)
+            total = self.jitter(image=image)
             image = total["image"]
             
-        total = A.Resize(self.trainsize, self.trainsize)(image=image, mask=gt)
-        image = total["image"]
-        gt = total['mask']
+        if image.shape[:2] != (size, size):
+            total = self.resize(size)(image=image, mask=gt)
+            image = total["image"]
+            gt = total['mask']
         random.seed(seed) # apply this seed to img transforms
         torch.manual_seed(seed) # needed for torchvision 0.7
 
         use_zeroed = True # 1 in 5 chance of grf tensor being zeroed during training
-        if use_zeroed and (random.randint(1, 5) == 2):
+        if self.grf_synth:
+            # zeroed here, the grf channel is synthesised for the whole batch (see utils/grf.py)
+            pad = np.zeros((size, size), dtype=np.uint8)
+            image = cv2.merge([image, pad])
+        elif use_zeroed and (random.randint(1, 5) == 2):
             # use zeroed tensor instead of grf channel
-            pad = np.zeros((512, 512), dtype=np.uint8)
+            pad = np.zeros((size, size), dtype=np.uint8)
             image = cv2.merge([image, pad])
+        elif self.grf_store is not None:
+            # grf channel from the store, already at training resolution
+            grf = self.grf_store[name.split(os.sep)[-1].split('.')[0]]
+            if grf.shape[:2] != (size, size):
+                grf = self.resize(size)(image=np.asarray(grf))["image"]
+            image = cv2.merge([image, grf])
+        elif grf is not None:
+            # cached grf channel, at training resolution
+            if grf.shape[:2] != (size, size):
+                grf = self.resize(size)(image=np.asarray(grf))["image"]
+            image = cv2.merge([image, grf])
         else:
             # use actual grf channel
-            grf_file = name.replace('/train', '')
-            grf_file = grf_file.replace('/val', '')
-            grf_file = grf_file.replace('/masks/', '/grf/')
-            grf = cv2.imread(grf_file, cv2.IMREAD_GRAYSCALE) # single channel grf
-            grf_tot = A.Resize(self.trainsize, self.trainsize)(image=grf)
+            grf = cv2.imread(grf_path(name), cv2.IMREAD_GRAYSCALE) # single channel grf
+            grf_tot = self.resize(size)(image=grf)
             grf = grf_tot["image"]
             grf = np.array(grf)
             image = cv2.merge([image, grf])
         
         image_final = self.totensor(image=image)
-        image = image_final["image"]
+        if self.batch_augment:
+            # augmented and normalised on the whole batch
+            return image_final["image"], torch.from_numpy(gt).unsqueeze(0).float() / 255, name
+        image = image_final["image"].float() / 255 # mean/std are given for [0, 1]
         image = self.nom(image)
 
-        gt_final = self.totensor(image=total["mask"], mask=total["mask"])
-        gt = gt_final["mask"]
+        gt_final = self.totensor(image=gt, mask=gt)
+        gt = gt_final["mask"].float() / 255
+        if self.loss_targets:
+            return image, gt.unsqueeze(0), name, torch.from_numpy(loss_targets(gt.numpy()))
         return image, gt.unsqueeze(0), name
 
     def __len__(self):
@@ -218,24 +283,20 @@ class test_dataset(data.Dataset):
         data_path: the path that contains images and masks.
         size: resize all images to trainsize for training
         rect: padding image to square before resize to keep its aspect ratio
+        manifest: JSON file to keep the index of data_path in (see utils/manifest.py)
+        stats: JSON sidecar with the mean/std. the model was trained with
     '''
-    def __init__(self, data_path, size, rect):
+    def __init__(self, data_path, size, rect, manifest=None, stats=None):
         self.trainsize = size
         try:
-            f = []
-            for p in data_path if isinstance(data_path, list) else [data_path]:
-                p = Path(p)
-                f += glob.glob(str(p / '**' / '*.*'), recursive=True)
-            self.images = sorted([x for x in f if 'image' in x])
+            self.images = [s['image'] for s in DatasetManifest(data_path, manifest).samples]
             length = len(self.images)
             
         except Exception as e:
             raise Exception('Error loading data from %s: %s\n' % (data_path, e))
 
         print('load %g all images'%length, 'from', data_path)
-        #mean, std = calculatemns(self.images, self.trainsize, rect)
-        #print('mean:', mean, ' std:', std)
-        mean, std = ([0.485, 0.456, 0.406, 0.1055],[0.229, 0.224, 0.225, 0.1647]) # ImageNet RGB + dataset eY
+        mean, std = load_stats(stats) if stats else (DEFAULT_MEAN, DEFAULT_STD)
         
         self.rect = rect
         self.size = len(self.images)
@@ -258,13 +319,13 @@ class test_dataset(data.Dataset):
 
         image = np.array(image)
 		# assuming no grf inputs for test set, so use zeroed tensor for 4th input channel
-        pad = np.zeros((512, 512), dtype=np.uint8)
+        pad = np.zeros((self.trainsize, self.trainsize), dtype=np.uint8)
         image = cv2.merge([image, pad])
 
         image0 = image.copy()
 
         image_final = self.totensor(image=image)
-        image = image_final["image"]
+        image = image_final["image"].float() / 255 # mean/std are given for [0, 1]
         image = self.nom(image)
         
         return image.unsqueeze(0), name, (h, w), image0
@@ -0,0 +1,53 @@
+import contextlib
+import torch
+
+
+def select_device(device='', index=None):
+    ''' torch.device of a --device option
+    Args:
+        device: cpu, cuda, cuda:1, mps, ...; '' for cuda if available, otherwise the cpu
+        index: device index to use if device has none, e.g. the local rank of a distributed run
+    '''
+    if not device:
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    device = torch.device(device)
+    if device.index is None and index is not None and device.type != 'cpu':
+        device = torch.device(device.type, index)
+    if device.type == 'cuda':
+        if not torch.cuda.is_available():
+            raise SystemExit('--device %s requested, but cuda is not available' % device)
+        torch.cuda.set_device(device)
+    return device
+
+def autocast(device, enabled=True):
+    ''' mixed precision on device: float16 on cuda, bfloat16 on the cpu, none elsewhere '''
+    if device.type == 'cuda':
+        return torch.autocast('cuda', dtype=torch.float16, enabled=enabled)
+    if device.type == 'cpu':
+        return torch.autocast('cpu', dtype=torch.bfloat16, enabled=enabled)
+    return contextlib.nullcontext()
+
+def grad_scaler(device, enabled=True):
+    ''' loss scaling is only needed for float16, bfloat16 has the range of float32 '''
+    return torch.cuda.amp.GradScaler(enabled=enabled and device.type == 'cuda')
+
+def synchronize(device):
+    ''' wait for the queued work of device, e.g. to time it '''
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    elif device.type == 'mps':
+        torch.mps.synchronize()
+
+def memory_reserved(device):
+    ''' GB reserved by the caching allocator of device, 0 where there is none '''
+    if device.type == 'cuda':
+        return torch.cuda.memory_reserved(device) / 1E9
+    return 0.
+
+def to_channels_last(x, enabled=True):
+    ''' NHWC memory layout for a model or batch, faster convolutions with oneDNN and tensor cores '''
+    if not enabled:
+        return x
+    if isinstance(x, torch.nn.Module):
+        return x.to(memory_format=torch.channels_last)
+    return x.contiguous(memory_format=torch.channels_last)
@@ -0,0 +1,71 @@
+import os
+from contextlib import contextmanager
+
+import torch.nn as nn
+import torch.distributed as dist
+
+from utils.device import select_device
+
+
+def setup_distributed(device=''):
+    ''' join the process group of a torchrun launch, NCCL on gpus and gloo on the cpu
+    Args:
+        device: --device option, see utils.device.select_device
+    Return:
+        global rank (-1 without torchrun), world size, local rank, device of this process
+    '''
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    rank = int(os.environ.get('RANK', -1))
+    local_rank = int(os.environ.get('LOCAL_RANK', -1))
+    device = select_device(device, max(local_rank, 0))
+    if world_size > 1 and not dist.is_initialized():
+        dist.init_process_group('nccl' if device.type == 'cuda' else 'gloo')
+    return rank, world_size, local_rank, device
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+def unwrap(model):
+    ''' the model inside (Distributed)DataParallel and torch.compile wrappers '''
+    if isinstance(model, (nn.parallel.DataParallel, nn.parallel.DistributedDataParallel)):
+        model = model.module
+    return getattr(model, '_orig_mod', model)
+
+def per_rank(obj):
+    ''' [obj of every process] in a distributed run, obj otherwise, e.g. to checkpoint RNG states '''
+    if not is_distributed():
+        return obj
+    objs = [None] * dist.get_world_size()
+    dist.all_gather_object(objs, obj)
+    return objs
+
+def of_rank(obj, rank):
+    ''' the part of a per_rank() object that belongs to rank '''
+    return obj[max(rank, 0)] if isinstance(obj, list) else obj
+
+def broadcast(obj, src=0):
+    ''' obj of process src on every process, e.g. a randomly drawn seed '''
+    if not is_distributed():
+        return obj
+    objs = [obj]
+    dist.broadcast_object_list(objs, src)
+    return objs[0]
+
+@contextmanager
+def zero_first(rank):
+    ''' let the first process run a block before the others, e.g. to write the dataset caches once
+    that the other processes then read
+    '''
+    if rank > 0:
+        barrier()
+    yield
+    if rank == 0:
+        barrier()
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+def cleanup():
+    if is_distributed():
+        dist.destroy_process_group()
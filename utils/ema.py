@@ -14,35 +14,63 @@ class ModelEMA:
     GPU assignment and distributed training wrappers.
     """
 
-    def __init__(self, model, decay=0.9999, updates=0):
+    def __init__(self, model, decay=0.9999, updates=0, compile=False, interval=1, device=None):
         # Create EMA
         self.ema = deepcopy(model.module if type(model) in (nn.parallel.DataParallel, \
                                     nn.parallel.DistributedDataParallel) else model).eval()  # FP32 EMA
-        # if next(model.parameters()).device.type != 'cpu':
-        #     self.ema.half()  # FP16 EMA
+        # e.g. on the cpu, to not double the weights in device memory; stays in float32, the
+        # (1 - decay) ~ 1e-4 increments round away in bfloat16 or float16
+        if device is not None:
+            self.ema.to(device=device)
         self.updates = updates  # number of EMA updates
                                 # modify it if start epoch != 0
         self.decay = lambda x: decay * (1 - math.exp(-x / 2000))  # decay exponential ramp (to help early epochs)
+        self.interval = interval  # optimizer steps between EMA updates
         for p in self.ema.parameters():
             p.requires_grad_(False)
+        # fused compiled kernels for the whole update instead of two ops per tensor
+        self._step = torch.compile(_ema_step) if compile else None
+        self._model = None  # model the tensor lists below were collected from
+        self._ema_tensors, self._model_tensors = [], []
+
+    def _collect(self, model):
+        # flat lists of the floating point parameters and buffers, collected once per model
+        msd = model.state_dict()
+        pairs = [(v, msd[k]) for k, v in self.ema.state_dict().items() if v.dtype.is_floating_point]
+        self._ema_tensors = [e for e, _ in pairs]
+        self._model_tensors = [m for _, m in pairs]
+        self._model = model
 
     def update(self, model):
-        # Update EMA parameters
+        # Update EMA parameters, every interval calls with the decay of interval updates
+        self.updates += 1
+        if self.updates % self.interval != 0:
+            return
+        model = model.module if type(model) in (nn.parallel.DataParallel, nn.parallel.DistributedDataParallel) else model
         with torch.no_grad():
-            self.updates += 1
-            d = self.decay(self.updates)
-
-            msd = model.module.state_dict() if type(model) in (nn.parallel.DataParallel, \
-                                    nn.parallel.DistributedDataParallel) else model.state_dict()  # model state_dict
-            for k, v in self.ema.state_dict().items():
-                if v.dtype.is_floating_point:
-                    v *= d
-                    v += (1. - d) * msd[k].detach()
+            d = self.decay(self.updates) ** self.interval
+            if model is not self._model:
+                self._collect(model)
+            ema, msd = self._ema_tensors, self._model_tensors
+            if len(ema) == 0:
+                return
+            if msd[0].device != ema[0].device:
+                msd = [m.to(e.device) for e, m in zip(ema, msd)]
+            if self._step is not None:
+                # the decay as a tensor, so a new value does not recompile
+                self._step(ema, msd, torch.tensor(1. - d, device=ema[0].device))
+            else:
+                torch._foreach_mul_(ema, d)
+                torch._foreach_add_(ema, msd, alpha=1. - d)
 
     def update_attr(self, model, include=(), exclude=('process_group', 'reducer')):
         # Update EMA attributes
         copy_attr(self.ema, model, include, exclude)
 
+def _ema_step(ema, model, weight):
+    for e, m in zip(ema, model):
+        e.lerp_(m, weight)
+
 def copy_attr(a, b, include=(), exclude=()):
     # Copy attributes from b to a, options to only include [...] and to exclude [...]
     for k, v in b.__dict__.items():
@@ -0,0 +1,92 @@
+import os
+import sys
+import time
+import subprocess
+import torch
+
+
+def device_slots(workers, cuda=True):
+    ''' environment and cpu set of every concurrent fold worker: one gpu each (round robin if
+    there are more workers than gpus), or an equal share of the cpu cores of this process
+    Args:
+        workers: # folds trained at once
+        cuda: use the gpus if there are any
+    Return:
+        list of (environment variables, cpu set or None)
+    '''
+    if cuda and torch.cuda.is_available():
+        return [({'CUDA_VISIBLE_DEVICES': str(i % torch.cuda.device_count())}, None) for i in range(workers)]
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count()))
+    share = max(len(cores) // workers, 1)
+    slots = []
+    for i in range(workers):
+        group = cores[i * share:(i + 1) * share] or cores[i % len(cores):i % len(cores) + 1]
+        threads = str(len(group))
+        slots.append(({'CUDA_VISIBLE_DEVICES': '', 'OMP_NUM_THREADS': threads, 'MKL_NUM_THREADS': threads}, set(group)))
+    return slots
+
+
+class FoldScheduler():
+    ''' trains the folds of a k-fold run as separate `train.py --k <fold>` processes, up to one per
+    device slot at a time; a failed fold is restarted from its latest checkpoint up to retries times
+    Args:
+        argv: train.py arguments shared by every fold, incl. the seed of the split and the run id
+            that a restarted fold checks its checkpoints against
+        folds: folds to train
+        workers: # folds trained at once
+        log_dir: directory of the fold-<k>.out files the output of the workers goes to
+        retries: # restarts of a failed fold
+        cuda: spread the folds over the gpus, otherwise over the cpu cores
+    '''
+    def __init__(self, argv, folds, workers, log_dir, retries=1, cuda=True):
+        self.argv = list(argv)
+        self.folds = list(folds)
+        self.slots = device_slots(min(workers, len(self.folds)), cuda)
+        self.log_dir = log_dir
+        self.retries = retries
+        os.makedirs(log_dir, exist_ok=True)
+
+    def _launch(self, fold, slot, attempt):
+        env, cpus = self.slots[slot]
+        args = [sys.executable, os.path.abspath(sys.argv[0])] + self.argv + ['--k', str(fold)]
+        if attempt > 0:
+            args += ['--resume'] # the latest checkpoint of this fold, if it got that far
+        log = open(os.path.join(self.log_dir, 'fold-%d.out' % fold), 'a' if attempt > 0 else 'w')
+        print('fold %g (attempt %g) on %s, output in %s' % (fold, attempt + 1, env.get('CUDA_VISIBLE_DEVICES') or 'cpus %s' % sorted(cpus), log.name))
+        proc = subprocess.Popen(args, env=dict(os.environ, **env), stdout=log, stderr=subprocess.STDOUT,
+                                preexec_fn=(lambda: os.sched_setaffinity(0, cpus)) if cpus is not None and hasattr(os, 'sched_setaffinity') else None)
+        log.close()
+        return proc
+
+    def run(self, poll=5.):
+        ''' train every fold
+        Return:
+            {fold: exit code of its last attempt}
+        '''
+        queue = [(fold, 0) for fold in self.folds]
+        running = {} # slot: (fold, attempt, process)
+        codes = {}
+        try:
+            while queue or running:
+                for slot in range(len(self.slots)):
+                    if slot not in running and queue:
+                        fold, attempt = queue.pop(0)
+                        running[slot] = (fold, attempt, self._launch(fold, slot, attempt))
+                time.sleep(poll)
+                for slot, (fold, attempt, proc) in list(running.items()):
+                    code = proc.poll()
+                    if code is None:
+                        continue
+                    del running[slot]
+                    codes[fold] = code
+                    if code == 0:
+                        print('fold %g done' % fold)
+                    elif attempt < self.retries:
+                        print('fold %g failed with exit code %g, retrying' % (fold, code))
+                        queue.append((fold, attempt + 1))
+                    else:
+                        print('fold %g failed with exit code %g, see %s' % (fold, code, os.path.join(self.log_dir, 'fold-%d.out' % fold)))
+        finally:
+            for _, _, proc in running.values():
+                proc.terminate()
+        return codes
@@ -0,0 +1,71 @@
+import os
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from generate_grf_images import frequency_grid, grey_lut, read_metadata, spectral_index
+
+
+def read_spectral_indices(csv_path, column, pi, discrete, image_column='image'):
+    ''' name -> GRF power law exponent for every row of the metadata csv
+    Args:
+        csv_path: path to metadata csv file
+        column, pi, discrete: GRF variant, as in generate_grf_images.py --field
+        image_column: csv column with the image filename
+    '''
+    rows = read_metadata(csv_path, [column], image_column)
+    return {filename.split('.')[0]: spectral_index(values[column], pi, discrete) for filename, values in rows}
+
+
+class GRFSynthesizer(nn.Module):
+    ''' GRF channel of a batch, synthesised with torch.fft from one metadata value per sample
+    Reproduces generate_grf_images.py followed by the resize and normalisation of the
+    dataloader, so the seeded noise spectrum is computed once and no GRF images are needed.
+    Args:
+        seed: fixed random seed of the metadata type
+        alphas: name -> power law exponent, see read_spectral_indices
+        size: (rows, cols) of the generated field, before resizing
+        mean: mean of the GRF channel for normalisation
+        std: std. of the GRF channel for normalisation
+    '''
+    def __init__(self, seed, alphas=None, size=(480, 640), mean=0.1055, std=0.1647):
+        super(GRFSynthesizer, self).__init__()
+        assert size[0] % 2 == 0 and size[1] % 2 == 0, 'only even GRF sizes can be synthesised with rfft'
+        self.size = tuple(size)
+        self.alphas = alphas if alphas is not None else {}
+        self.mean = mean
+        self.std = std
+        # same draw as np.random.seed(seed); np.random.normal(size=size) in generate_grf_images.py
+        noise = torch.from_numpy(np.random.RandomState(seed).normal(size=self.size)).float()
+        k = torch.from_numpy(frequency_grid(self.size, np.float32)[:, :self.size[1]//2 + 1])
+        self.register_buffer('spectrum', torch.fft.rfft2(noise), persistent=False)
+        self.register_buffer('k', k, persistent=False)
+        self.register_buffer('lut', torch.from_numpy(grey_lut().astype(np.float32)), persistent=False)
+
+    @torch.no_grad()
+    def forward(self, alpha, out_size=(512, 512)):
+        ''' alpha: (B,) power law exponents -> (B, 1, *out_size) normalised GRF channel '''
+        alpha = alpha.to(self.k).view(-1, 1, 1)
+        valid = self.k > 0
+        amplitude = torch.where(valid, torch.sqrt(torch.where(valid, self.k, 1).pow(alpha)), 0)
+        field = torch.fft.irfft2(self.spectrum * amplitude, s=self.size)
+
+        # greyscale image as written by generate_grf_images.save_grf
+        vmin = field.amin(dim=(1, 2), keepdim=True)
+        vmax = field.amax(dim=(1, 2), keepdim=True)
+        x = (field - vmin) / (vmax - vmin).clamp_min(torch.finfo(field.dtype).tiny)
+        grey = self.lut[(x * 256).long().clamp(0, 255)]
+
+        grf = F.interpolate(grey.unsqueeze(1), size=tuple(out_size), mode='bilinear', align_corners=False)
+        return (grf / 255 - self.mean) / self.std
+
+    def fill(self, images, names, p_zero=0.2):
+        ''' write the GRF of each sample into the 4th channel of images (in place)
+        as in the dataloader, the zeroed channel is kept for a p_zero share of the samples
+        '''
+        alpha = torch.tensor([self.alphas[n.split(os.sep)[-1].split('.')[0]] for n in names], device=images.device)
+        keep = (torch.rand(len(names), device=images.device) >= p_zero).view(-1, 1, 1, 1)
+        grf = self(alpha, images.shape[-2:]).to(images.dtype)
+        images[:, 3:] = torch.where(keep, grf, images[:, 3:])
+        return images
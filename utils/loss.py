@@ -5,24 +5,34 @@ import numpy as np
 from tqdm import tqdm
 from typing import Optional
 
+from utils.profiler import profile_stage
+
 
 class Lossncriterion(nn.Module):
     def __init__(self):
         super(Lossncriterion, self).__init__()
-        self.laplacian = torch.tensor([[[[-1, -1, -1], [-1, 8, -1], [-1, -1, -1]]]], dtype=torch.half).requires_grad_(False).cuda()
+        self.register_buffer('laplacian', torch.tensor([[[[-1, -1, -1], [-1, 8, -1], [-1, -1, -1]]]], dtype=torch.float), persistent=False)
         self.converter = nn.Sigmoid()
         
     def dice_coefficient(self, inputs, targets):
         inputs = torch.nn.Sigmoid()(inputs)
         inputs = (inputs > 0.5).float()
-        if targets.sum() == 0:
-            if inputs.sum() == 0:
-                return torch.tensor(1., device="cuda")
-            else:
-                return torch.tensor(0., device="cuda")
+        # an empty mask scores 1 if nothing is predicted and 0 otherwise, without a host sync
+        empty = targets.sum() == 0
         intersection = torch.sum(inputs * targets)
-        dice = (2 * intersection) / ((inputs.sum() + targets.sum()) * 1.0)
-        return dice
+        total = inputs.sum() + targets.sum()
+        dice = (2 * intersection) / torch.where(empty, torch.ones_like(total), total * 1.0)
+        return torch.where(empty, (inputs.sum() == 0).float(), dice)
+    
+    def dice_per_image(self, inputs, targets):
+        ''' dice_coefficient of every image of a batch, (B,) '''
+        inputs = (torch.sigmoid(inputs) > 0.5).float().flatten(1)
+        targets = targets.flatten(1)
+        empty = targets.sum(1) == 0
+        intersection = torch.sum(inputs * targets, 1)
+        total = inputs.sum(1) + targets.sum(1)
+        dice = (2 * intersection) / torch.where(empty, torch.ones_like(total), total * 1.0)
+        return torch.where(empty, (inputs.sum(1) == 0).float(), dice)
     
     def binary_dice(self, inputs, targets):
         smooth = 1.
@@ -30,20 +40,97 @@ class Lossncriterion(nn.Module):
         dice = (2 * intersection + smooth) / (inputs.pow(2).sum() + targets.pow(2).sum() + smooth)
         return 1 - dice
         
-    def forward(self, inputs, target):
-        wbce, wiou = structure_loss(inputs, target)
+    def forward(self, inputs, target, weit=None):
+        wbce, wiou = structure_loss(inputs, target, weit)
         loss = wbce.mean() + wiou.mean()
         return loss
 
-    def boundary_forward(self, pred, gt):
+    def multi_head(self, inputs, target, weit=None):
+        ''' forward() of several heads on one target, with the weight map computed once and all
+        heads in one pass
+        Args:
+            inputs: outputs of the heads, (B, C_i, H, W) each
+            weit: structure_weight(target) if already known, e.g. from the DataLoader workers
+        Return:
+            loss of every head
+        '''
+        wbce, wiou = structure_loss(torch.cat(inputs, 1), target, structure_weight(target) if weit is None else weit)
+        sizes = [x.size(1) for x in inputs]
+        return [b.mean() + u.mean() for b, u in zip(wbce.split(sizes, 1), wiou.split(sizes, 1))]
+
+    def boundary_target(self, gt):
+        ''' edges of the ground truth, the target of boundary_forward '''
+        return (F.conv2d(gt.float(), self.laplacian, stride=1, padding = 1) > 0.1).float()
+
+    def boundary_forward(self, pred, gt, target=None):
         pred = nn.Sigmoid()(pred)
-        gt = (F.conv2d(gt.float(), self.laplacian, stride=1, padding = 1) > 0.1).float()
+        gt = self.boundary_target(gt) if target is None else target
         bce_loss = F.binary_cross_entropy_with_logits(pred, gt.expand(gt.size(0), pred.size(1), gt.size(2), gt.size(3)))
         return bce_loss
 
-def structure_loss(pred, mask):
-    weit = 1 + 5*torch.abs(F.avg_pool2d(mask, kernel_size=31, stride=1, padding=15) - mask)
-    wbce = F.binary_cross_entropy_with_logits(pred, mask, reduction='none')
+class DeepSupervisionLoss(nn.Module):
+    ''' weighted sum of the losses of the four lawin outputs, so a step needs a single backward
+    Args:
+        criterion: Lossncriterion for the main, deep1 and deep2 outputs and the boundary output
+        weights: weights of the main, deep1, deep2 and boundary terms, terms weighted 0 are not computed
+    '''
+    names = ('main', 'deep1', 'deep2', 'boundary')
+
+    def __init__(self, criterion, weights=(1., 1., 1., 1.)):
+        super(DeepSupervisionLoss, self).__init__()
+        assert len(weights) == len(self.names), 'one weight per term: %s' % ', '.join(self.names)
+        self.criterion = criterion
+        self.weights = [float(w) for w in weights]
+        self.profiler = None  # utils.profiler.StepProfiler timing every term, see train.py --profile
+
+    def forward(self, outputs, gts, targets=None):
+        ''' total loss and the detached (unweighted) terms for logging, 0 for the skipped ones
+        targets: (B, 2, H, W) weight maps and boundary targets of gts if precomputed (utils/targets.py)
+        '''
+        weit, boundary = (targets[:, :1], targets[:, 1:2]) if targets is not None else (None, None)
+        terms = [None] * len(self.names)
+        # the structure losses of the main, deep1 and deep2 heads share one weight map and one pass
+        heads = [i for i in range(3) if self.weights[i] != 0]
+        if len(heads) > 0:
+            with profile_stage(self.profiler, 'loss_structure'):
+                for i, term in zip(heads, self.criterion.multi_head([outputs[i] for i in heads], gts, weit)):
+                    terms[i] = term
+        if self.weights[3] != 0:
+            with profile_stage(self.profiler, 'loss_boundary'):
+                terms[3] = self.criterion.boundary_forward(outputs[3], gts, boundary)
+
+        total = 0.
+        for i, w in enumerate(self.weights):
+            if w == 0:
+                terms[i] = torch.zeros((), device=gts.device)
+                continue
+            total = total + w * terms[i]
+            terms[i] = terms[i].detach()
+        return total, terms
+
+def box_filter(x, kernel_size):
+    ''' F.avg_pool2d(x, kernel_size, stride=1, padding=kernel_size // 2) of an odd kernel_size, from
+    running sums along each axis (separable integral image), so its cost does not grow with kernel_size
+    '''
+    r = kernel_size // 2
+    # one more leading zero, the window sums are differences of the running sums
+    x = F.pad(x.float(), (r + 1, r, r + 1, r))
+    x = x.cumsum(-1)
+    x = x[..., kernel_size:] - x[..., :-kernel_size]
+    x = x.cumsum(-2)
+    x = x[..., kernel_size:, :] - x[..., :-kernel_size, :]
+    return x / kernel_size ** 2
+
+def structure_weight(mask):
+    ''' weight map of structure_loss, larger close to the mask edges '''
+    return 1 + 5*torch.abs(box_filter(mask, 31) - mask)
+
+def structure_loss(pred, mask, weit=None):
+    ''' per image and channel weighted BCE and IoU losses, (B, C) each; pred may have more
+    channels than mask, e.g. several heads concatenated, and weit is structure_weight(mask) '''
+    if weit is None:
+        weit = structure_weight(mask)
+    wbce = F.binary_cross_entropy_with_logits(pred, mask.expand_as(pred), reduction='none')
     wbce = (weit*wbce).sum(dim=(2, 3)) / weit.sum(dim=(2, 3))
     
     pred = torch.sigmoid(pred)
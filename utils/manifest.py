@@ -0,0 +1,118 @@
+import os
+import json
+
+from pathlib import Path
+from PIL import Image
+
+
+IMAGE_EXT = ('.jpg', '.png')
+
+# manifests already loaded in this process, by data paths
+_manifests = {}
+
+
+def grf_path(mask_path):
+    ''' grf image of a sample, dataset/(train|val)/masks/x.png -> dataset/grf/x.png '''
+    grf_file = mask_path.replace('/train', '')
+    grf_file = grf_file.replace('/val', '')
+    grf_file = grf_file.replace('/masks/', '/grf/')
+    return grf_file
+
+
+def scan(roots):
+    ''' one walk over the data paths
+    Args:
+        roots: data paths that contain images/ and masks/ folders
+    Return:
+        samples sorted by image path, with the mask and grf path and the (h, w) of the image,
+        and the mtime of every directory walked
+    '''
+    dirs, images, masks = {}, [], {}
+    for root in roots:
+        for d, subdirs, files in os.walk(root):
+            subdirs[:] = sorted(s for s in subdirs if not s.startswith('.'))
+            dirs[d] = os.stat(d).st_mtime_ns
+            for f in files:
+                if f.startswith('.') or not f.endswith(IMAGE_EXT):
+                    continue
+                path = os.path.join(d, f)
+                if 'images' in path:
+                    images.append((root, path))
+                if 'masks' in path:
+                    key = (root, f.split('.')[0])
+                    if key in masks:
+                        raise ValueError('masks %s and %s have the same name' % (masks[key], path))
+                    masks[key] = path
+
+    samples = []
+    for root, path in sorted(images, key=lambda x: x[1]):
+        stem = path.split(os.sep)[-1].split('.')[0]
+        mask = masks.get((root, stem))
+        with Image.open(path) as image:
+            w, h = image.size # only reads the header
+        samples.append({'stem': stem, 'image': path, 'mask': mask,
+                        'grf': grf_path(mask) if mask is not None else None, 'size': [h, w]})
+    return samples, dirs
+
+
+class DatasetManifest():
+    ''' images, masks and GRF paths of the data paths, built by one scan and reused
+    The manifest is kept for the whole process and, if path is given, saved as JSON.
+    It is rebuilt when a directory under the data paths changed (added/removed files).
+    Args:
+        data_path: path, or list of paths, that contain images and masks
+        path: JSON file to keep the manifest in between runs
+    '''
+    version = 1
+
+    def __init__(self, data_path, path=None):
+        self.roots = [str(Path(p)) for p in (data_path if isinstance(data_path, list) else [data_path])]
+        self.path = path
+        key = tuple(self.roots)
+
+        manifest = _manifests.get(key)
+        if manifest is None and path and os.path.exists(path):
+            with open(path) as f:
+                manifest = json.load(f)
+            if manifest.get('version') != self.version or manifest.get('roots') != self.roots:
+                manifest = None
+        if manifest is None or not self._valid(manifest):
+            samples, dirs = scan(self.roots)
+            manifest = {'version': self.version, 'roots': self.roots, 'dirs': dirs, 'samples': samples}
+            if path:
+                self._save(manifest)
+        _manifests[key] = manifest
+        self.samples = manifest['samples']
+
+    @staticmethod
+    def _valid(manifest):
+        for d, mtime in manifest['dirs'].items():
+            try:
+                if os.stat(d).st_mtime_ns != mtime:
+                    return False
+            except FileNotFoundError:
+                return False
+        return True
+
+    def _save(self, manifest):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(manifest, f)
+        os.replace(self.path + '.tmp', self.path)
+        own = [d for d in manifest['dirs'] if os.path.abspath(d) == os.path.abspath(os.path.dirname(self.path) or '.')]
+        if len(own) > 0:
+            # saved inside a data path, writing it changed the directory itself
+            for d in own:
+                manifest['dirs'][d] = os.stat(d).st_mtime_ns
+            with open(self.path, 'w') as f:
+                json.dump(manifest, f)
+
+    def paired(self):
+        ''' samples that have a mask, raises if any image has none '''
+        missing = [s['image'] for s in self.samples if s['mask'] is None]
+        if len(missing) > 0:
+            raise ValueError('%g images have no mask, e.g. %s' % (len(missing), missing[0]))
+        return self.samples
+
+    def __len__(self):
+        return len(self.samples)
@@ -0,0 +1,84 @@
+import torch
+
+from lib.kingnet import KingBlock
+from lib.lawinloss import LawinAttn
+from lib.layers import frozen_norm_stats
+from utils.device import autocast
+
+
+def checkpointable(model):
+    ''' modules of the model that support activation checkpointing '''
+    return [m for m in model.modules() if isinstance(m, (KingBlock, LawinAttn))]
+
+def activation_bytes(model, sample, amp=False):
+    ''' bytes kept for backward by one training forward of sample, in total and per checkpointable module
+    Measured with saved tensor hooks, so it works on any device; running norm statistics are not changed.
+    amp runs the forward under the autocast of the training step, which halves most saved activations.
+    Return:
+        total bytes, {module: (bytes saved inside it, bytes of its inputs)}
+    '''
+    modules = checkpointable(model)
+    per_module = {m: [0, 0] for m in modules}
+    stack, seen = [], set()
+    total = [0]
+
+    def pack(t):
+        key = (t.data_ptr(), t.numel(), t.dtype)
+        if key not in seen:
+            seen.add(key)
+            size = t.numel() * t.element_size()
+            total[0] += size
+            if len(stack) > 0:
+                per_module[stack[-1]][0] += size
+        return t
+
+    def pre_hook(m, inputs):
+        stack.append(m)
+        per_module[m][1] = sum(x.numel() * x.element_size() for x in inputs if torch.is_tensor(x))
+
+    def hook(m, inputs, output):
+        stack.pop()
+
+    handles = [h for m in modules for h in (m.register_forward_pre_hook(pre_hook), m.register_forward_hook(hook))]
+    use_checkpoint = [m.use_checkpoint for m in modules]
+    training = model.training
+    try:
+        for m in modules:
+            m.use_checkpoint = False
+        model.train()
+        with frozen_norm_stats(model), torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t), autocast(sample.device, amp):
+            model(sample)
+    finally:
+        for h in handles:
+            h.remove()
+        for m, c in zip(modules, use_checkpoint):
+            m.use_checkpoint = c
+        model.train(training)
+    return total[0], {m: tuple(v) for m, v in per_module.items()}
+
+def set_activation_checkpointing(model, sample, budget, batchsize=1, amp=False):
+    ''' checkpoint the KingBlock/LawinAttn modules that keep the most activations, until a batch fits the budget
+    Args:
+        model: model to configure
+        sample: (1, C, H, W) input at the largest training size
+        budget: bytes the activations of one batch may take
+        batchsize: # samples per (micro) batch, activations grow linearly with it
+        amp: training uses mixed precision
+    Return:
+        # modules checkpointed, estimated activation bytes of a batch
+    '''
+    total, per_module = activation_bytes(model, sample, amp)
+    estimate = total * batchsize
+    # checkpointing a module keeps only its inputs instead of everything saved inside it
+    gains = sorted((((saved - inputs) * batchsize, m) for m, (saved, inputs) in per_module.items()), key=lambda x: x[0])
+    n = 0
+    for m in checkpointable(model):
+        m.use_checkpoint = False
+    while estimate > budget and len(gains) > 0:
+        gain, m = gains.pop()
+        if gain <= 0:
+            break
+        m.use_checkpoint = True
+        estimate -= gain
+        n += 1
+    return n, estimate
@@ -1,11 +1,20 @@
 import numpy as np
 import torch
 import torch.nn.functional as F
+import torch.distributed as dist
 
 
 def iou_score(output, target):
     smooth = 1e-5
 
+    if torch.is_tensor(output) and torch.is_tensor(target):
+        # stays on the device, no host sync
+        output_ = torch.sigmoid(output.detach()) > 0.5
+        target_ = target.detach() > 0.5
+        intersection = (output_ & target_).sum()
+        union = (output_ | target_).sum()
+        return (intersection + smooth) / (union + smooth)
+
     if torch.is_tensor(output):
         output = torch.sigmoid(output).data.cpu().numpy()
     if torch.is_tensor(target):
@@ -19,6 +28,16 @@ def iou_score(output, target):
     return (intersection + smooth) / (union + smooth)
 
 
+def iou_per_image(output, target):
+    ''' iou_score of every image of a batch, (B,) on the device '''
+    smooth = 1e-5
+    output_ = (torch.sigmoid(output.detach()) > 0.5).flatten(1)
+    target_ = (target.detach() > 0.5).flatten(1)
+    intersection = (output_ & target_).sum(1)
+    union = (output_ | target_).sum(1)
+    return (intersection + smooth) / (union + smooth)
+
+
 def dice_coef(output, target):
     smooth = 1e-5
 
@@ -28,3 +47,45 @@ def dice_coef(output, target):
 
     return (2. * intersection + smooth) / \
         (output.sum() + target.sum() + smooth)
+
+
+class MetricAccumulator():
+    ''' running averages of several metrics, summed on the device and only synced when read
+    Args:
+        names: names of the metrics
+    '''
+    def __init__(self, names):
+        self.names = list(names)
+        self.reset()
+
+    def reset(self):
+        self.sums = None
+        self.count = 0
+
+    def update(self, n=1, **values):
+        ''' add the (scalar tensor) value of every metric, weighted by n '''
+        vals = [torch.as_tensor(values[k]).detach().reshape(()) for k in self.names]
+        if self.sums is None:
+            device = vals[0].device
+            self.sums = torch.zeros(len(self.names), device=device, dtype=torch.float32 if device.type == 'mps' else torch.float64)
+        self.sums += torch.stack([v.to(self.sums) for v in vals]) * n
+        self.count += n
+
+    def averages(self):
+        ''' {name: average}, a single device -> host copy '''
+        if self.sums is None:
+            return {k: 0. for k in self.names}
+        return dict(zip(self.names, (self.sums / self.count).tolist()))
+
+    def all_reduce(self, device=None):
+        ''' sum the metrics over every process of a distributed run, so averages() covers all of them
+        Args:
+            device: device of the sums of a process that saw no samples
+        '''
+        if not (dist.is_available() and dist.is_initialized()):
+            return
+        if self.sums is None:
+            self.sums = torch.zeros(len(self.names), device=device, dtype=torch.float64)
+        flat = torch.cat([self.sums, self.sums.new_tensor([self.count])])
+        dist.all_reduce(flat)
+        self.sums, self.count = flat[:-1], flat[-1].item()
@@ -0,0 +1,121 @@
+import os
+import json
+import time
+import contextlib
+import numpy as np
+import pandas as pd
+import torch
+
+from collections import OrderedDict
+
+
+def profile_stage(profiler, name):
+    ''' profiler.stage(name), or nothing without a profiler '''
+    return profiler.stage(name) if profiler is not None else contextlib.nullcontext()
+
+
+class StepProfiler():
+    ''' wall and device time of the stages of every training step, summarised with percentiles per epoch
+    Wall time is measured on the host without synchronising, device time with CUDA events (on the
+    cpu every op is synchronous, so it equals the wall time). Optionally captures a torch.profiler
+    trace of the steps trace[0] to trace[1].
+    Args:
+        device: training device
+        trace: (first, last) global step of the torch.profiler trace window, None for no trace
+        trace_path: chrome trace file the window is written to
+    '''
+    percentiles = (50, 90, 99)
+
+    def __init__(self, device, trace=None, trace_path='trace.json'):
+        self.device = device
+        self.trace = trace
+        self.trace_path = trace_path
+        self.torch_profiler = None
+        self.steps = 0
+        self.history = []
+        self._reset()
+        self.start()
+
+    def _reset(self):
+        self.wall = OrderedDict()  # stage: [seconds per step]
+        self.events = OrderedDict()  # stage: [(start, end) cuda events per step]
+        self.current = OrderedDict()  # stage: [wall seconds, [events]] of the running step
+
+    def start(self):
+        ''' start an epoch, the data wait of its first step counts from here and not from the
+        validation and checkpointing since the last step '''
+        self.last = time.perf_counter()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        ''' time a stage of the current step, a stage entered twice in a step is summed '''
+        if self.device.type == 'cuda':
+            start, end = torch.cuda.Event(enable_timing=True), torch.cuda.Event(enable_timing=True)
+            start.record()
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - t
+            entry = self.current.setdefault(name, [0., []])
+            entry[0] += wall
+            if self.device.type == 'cuda':
+                end.record()
+                entry[1].append((start, end))
+
+    def begin(self):
+        ''' start a step once its batch is there, the time since the last step is the data wait '''
+        self.current['data'] = [time.perf_counter() - self.last, []]
+        if self.trace is not None and self.steps == self.trace[0]:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if self.device.type == 'cuda':
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.torch_profiler = torch.profiler.profile(activities=activities, record_shapes=True, profile_memory=True, with_stack=True)
+            self.torch_profiler.start()
+
+    def end(self):
+        ''' end a step '''
+        for name, (wall, events) in self.current.items():
+            self.wall.setdefault(name, []).append(wall)
+            self.events.setdefault(name, []).append(events)
+        self.current = OrderedDict()
+        if self.torch_profiler is not None and self.steps == self.trace[1]:
+            self.torch_profiler.stop()
+            os.makedirs(os.path.dirname(self.trace_path) or '.', exist_ok=True)
+            self.torch_profiler.export_chrome_trace(self.trace_path)
+            print('profiler trace of steps %g-%g written to %s' % (self.trace[0], self.trace[1], self.trace_path))
+            self.torch_profiler = None
+        self.steps += 1
+        self.last = time.perf_counter()
+
+    def summary(self, epoch):
+        ''' per-stage statistics (ms) of the steps since the last summary, then starts over
+        Return:
+            list of {epoch, stage, steps, wall_mean, wall_p50, ..., device_mean, ...}, one per stage
+        '''
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+        rows = []
+        total = sum(sum(v) for v in self.wall.values())
+        for name, wall in self.wall.items():
+            row = OrderedDict([('epoch', epoch), ('stage', name), ('steps', len(wall)),
+                               ('share', sum(wall) / total if total > 0 else 0.)])
+            times = {'wall': np.array(wall) * 1E3}
+            if self.device.type == 'cuda' and name != 'data':
+                times['device'] = np.array([sum(s.elapsed_time(e) for s, e in events) for events in self.events[name]])
+            else:
+                times['device'] = times['wall']
+            for kind, t in times.items():
+                row[kind + '_mean'] = float(t.mean())
+                for q in self.percentiles:
+                    row['%s_p%d' % (kind, q)] = float(np.percentile(t, q))
+            rows.append(row)
+        self.history.extend(rows)
+        self._reset()
+        return rows
+
+    def save(self, path):
+        ''' write every summary so far to path.csv and path.json '''
+        pd.DataFrame(self.history).to_csv(path + '.csv', index=False)
+        with open(path + '.json', 'w') as f:
+            json.dump(self.history, f, indent=1)
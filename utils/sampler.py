@@ -0,0 +1,80 @@
+import math
+import random
+import torch.utils.data as data
+
+
+def multiscale_sizes(trainsize, multiscale=0.25, stride=64):
+    ''' training sizes within trainsize * (1 -+ multiscale), multiples of stride '''
+    low, high = int(trainsize * (1 - multiscale)), int(trainsize * (1 + multiscale))
+    sizes = sorted({s // stride * stride for s in range(low, max(high, low + 1))})
+    return [s for s in sizes if s > 0] or [trainsize]
+
+
+class MultiscaleBatchSampler(data.Sampler):
+    ''' batches of (index, size) pairs, every batch is loaded at one randomly chosen size
+    so the dataset resizes straight to it instead of the whole batch being interpolated later
+    Args:
+        sampler: sampler of the dataset indices (e.g. RandomSampler, DistributedSampler)
+        batch_size: # samples per batch
+        sizes: training sizes to choose from
+        drop_last: drop the last incomplete batch
+        seed: seed of the size choice, the epoch is added to it
+        progressive: # epochs over which the largest size grows from sizes[0] to sizes[-1], 0 to use all sizes from the start
+    '''
+    def __init__(self, sampler, batch_size, sizes, drop_last=False, seed=None, progressive=0):
+        self.sampler = sampler
+        self.batch_size = batch_size
+        self.sizes = sorted(sizes)
+        self.drop_last = drop_last
+        self.seed = seed
+        self.progressive = progressive
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        if hasattr(self.sampler, 'set_epoch'):
+            self.sampler.set_epoch(epoch)
+
+    def epoch_sizes(self):
+        ''' sizes allowed in the current epoch '''
+        if self.progressive <= 0:
+            return self.sizes
+        largest = self.sizes[0] + (self.sizes[-1] - self.sizes[0]) * min(1., (self.epoch + 1) / self.progressive)
+        return [s for s in self.sizes if s <= largest]
+
+    def __iter__(self):
+        rng = random.Random(None if self.seed is None else self.seed + self.epoch)
+        sizes = self.epoch_sizes()
+        batch = []
+        for idx in self.sampler:
+            batch.append(idx)
+            if len(batch) == self.batch_size:
+                size = rng.choice(sizes)
+                yield [(i, size) for i in batch]
+                batch = []
+        if len(batch) > 0 and not self.drop_last:
+            size = rng.choice(sizes)
+            yield [(i, size) for i in batch]
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.sampler) // self.batch_size
+        return math.ceil(len(self.sampler) / self.batch_size)
+
+
+class ShardSampler(data.Sampler):
+    ''' every num_replicas-th index from rank on, in order; unlike DistributedSampler it does not
+    pad the shards with repeated samples, so a sharded validation sees every sample exactly once
+    Args:
+        dataset: dataset to shard
+        num_replicas: # processes
+        rank: rank of this process
+    '''
+    def __init__(self, dataset, num_replicas, rank):
+        self.indices = range(len(dataset))[rank::num_replicas]
+
+    def __iter__(self):
+        return iter(self.indices)
+
+    def __len__(self):
+        return len(self.indices)
@@ -0,0 +1,124 @@
+import os
+import json
+import hashlib
+import cv2
+import numpy as np
+
+from multiprocessing import Pool
+from tqdm import tqdm
+from utils.utils import pad_to_square
+from utils.cache import file_state
+
+
+# ImageNet RGB + dataset eY, used when no statistics are computed
+DEFAULT_MEAN = [0.485, 0.456, 0.406, 0.1055]
+DEFAULT_STD = [0.229, 0.224, 0.225, 0.1647]
+
+
+def merge(a, b):
+    ''' Chan et al. parallel merge of two per channel (count, mean, M2) moments '''
+    na, ma, qa = a
+    nb, mb, qb = b
+    n = na + nb
+    delta = mb - ma
+    mean = ma + delta * nb / np.maximum(n, 1)
+    m2 = qa + qb + delta**2 * na * nb / np.maximum(n, 1)
+    return n, mean, m2
+
+def moments(x):
+    ''' (count, mean, M2) of every channel of an (H, W, C) array '''
+    x = x.reshape(-1, x.shape[-1]).astype(np.float64)
+    mean = x.mean(0)
+    return np.full(x.shape[1], len(x), dtype=np.float64), mean, ((x - mean)**2).sum(0)
+
+def _moments(args):
+    ''' moments of RGB + GRF of a chunk of samples, at training resolution and in [0, 1] '''
+    samples, size, rect, grf_store = args
+    if grf_store:
+        from utils.dataloader import GRFStore
+        grf_store = GRFStore(grf_store)
+    total = (np.zeros(4), np.zeros(4), np.zeros(4))
+    for sample in samples:
+        image = cv2.cvtColor(cv2.imread(sample['image']), cv2.COLOR_BGR2RGB)
+        if rect:
+            image, _ = pad_to_square(image, image[..., 0])
+        image = cv2.resize(image, (size, size), interpolation=cv2.INTER_LINEAR)
+        n, mean, m2 = moments(image / 255.)
+
+        grf = None
+        if grf_store and sample['stem'] in grf_store.index:
+            grf = np.asarray(grf_store[sample['stem']])
+        elif not grf_store and sample['grf'] is not None and os.path.exists(sample['grf']):
+            grf = cv2.imread(sample['grf'], cv2.IMREAD_GRAYSCALE)
+        if grf is not None:
+            # the GRF channel is resized without padding, as in the dataloader
+            if grf.shape[:2] != (size, size):
+                grf = cv2.resize(grf, (size, size), interpolation=cv2.INTER_LINEAR)
+            grf_moments = moments(grf[..., None] / 255.)
+        else:
+            grf_moments = (np.zeros(1), np.zeros(1), np.zeros(1))
+        total = merge(total, tuple(np.concatenate([a, b]) for a, b in zip((n, mean, m2), grf_moments)))
+    return total
+
+def dataset_stats(samples, size, rect, grf_store=None, workers=4, chunksize=64):
+    ''' streaming mean and std. of the RGB and GRF channels as the model sees them
+    Args:
+        samples: manifest samples (see utils/manifest.py)
+        size: training size the images are resized to
+        rect: images are padded to square before resizing
+        grf_store: .npy GRF store to read the GRF channel from instead of the grf images
+        workers: # processes, 0 to run in this process
+        chunksize: # samples per task
+    Return:
+        # pixels, mean and std. of the 4 channels; the GRF count is 0 if there are no GRFs
+    '''
+    chunks = [(samples[i:i + chunksize], size, rect, grf_store) for i in range(0, len(samples), chunksize)]
+    total = (np.zeros(4), np.zeros(4), np.zeros(4))
+    pool = Pool(workers) if workers > 0 else None
+    try:
+        results = pool.imap_unordered(_moments, chunks) if pool is not None else map(_moments, chunks)
+        for part in tqdm(results, total=len(chunks), desc='dataset statistics'):
+            total = merge(total, part)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    n, mean, m2 = total
+    return n, mean, np.sqrt(m2 / np.maximum(n, 1))
+
+def stats_key(samples, size, rect, grf_store=None):
+    ''' hash of everything the statistics depend on '''
+    h = hashlib.sha1(json.dumps([size, rect, grf_store or None, file_state(grf_store) if grf_store else None]).encode())
+    for s in samples:
+        h.update(json.dumps([s['image'], s['size'], file_state(s['image']), s['grf'],
+                             file_state(s['grf']) if s['grf'] is not None and not grf_store else None]).encode())
+    return h.hexdigest()
+
+def load_stats(path, samples=None, size=512, rect=False, grf_store=None, workers=4):
+    ''' mean and std. of the 4 input channels from the JSON sidecar at path
+    If samples is given, the sidecar is (re)computed when it is missing or was computed
+    from other samples or settings. Channels without data keep the default statistics.
+    '''
+    stats = None
+    if os.path.exists(path):
+        with open(path) as f:
+            stats = json.load(f)
+    if samples is not None:
+        key = stats_key(samples, size, rect, grf_store)
+        if stats is None or stats.get('key') != key:
+            n, mean, std = dataset_stats(samples, size, rect, grf_store, workers)
+            stats = {'key': key, 'size': size, 'rect': rect, 'grf_store': grf_store or None,
+                     'count': n.tolist(), 'mean': mean.tolist(), 'std': std.tolist()}
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            with open(path + '.tmp', 'w') as f:
+                json.dump(stats, f, indent=1)
+            os.replace(path + '.tmp', path)
+    elif stats is None:
+        raise FileNotFoundError('no dataset statistics at %s' % path)
+
+    valid = [c > 0 for c in stats['count']]
+    if not all(valid):
+        print('no data for channel(s) %s in %s, using the default statistics' % ([i for i, v in enumerate(valid) if not v], path))
+    mean = [m if v else d for m, v, d in zip(stats['mean'], valid, DEFAULT_MEAN)]
+    std = [s if v else d for s, v, d in zip(stats['std'], valid, DEFAULT_STD)]
+    return mean, std
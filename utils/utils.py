@@ -5,6 +5,7 @@ import numpy as np
 from PIL import Image
 import torchvision.transforms as transforms
 from lib.HarDMSEG import KingMSEG_lawin_loss, KingMSEG_lawin_loss4
+from utils.device import select_device
 
 # +
 def square_padding(image, w, h):
@@ -23,6 +24,22 @@ def square_padding(image, w, h):
 
     return image
 
+def pad_to_square(image, mask):
+    ''' zero-pad an image and its mask to a centred square,
+    same as A.PadIfNeeded(min_height=max(h, w), min_width=max(h, w))
+    with a constant border
+
+    numpy -> numpy
+    '''
+    h, w = image.shape[:2]
+    if h == w:
+        return image, mask
+    top, left = (max(h, w) - h) // 2, (max(h, w) - w) // 2
+    bottom, right = max(h, w) - h - top, max(h, w) - w - left
+    image = cv2.copyMakeBorder(image, top, bottom, left, right, cv2.BORDER_CONSTANT, value=0)
+    mask = cv2.copyMakeBorder(mask, top, bottom, left, right, cv2.BORDER_CONSTANT, value=0)
+    return image, mask
+
 def square_unpadding(image, w, h):
     ''' crop origin part of padded image
     +1//2 to avoid odd difference
@@ -61,12 +78,13 @@ class AvgMeter(object):
         return torch.mean(torch.stack(self.losses[np.maximum(len(self.losses)-self.num, 0):]))
 
 
-def build_model(modelname='lawinloss4', class_num=1, arch=53):
+def build_model(modelname='lawinloss4', class_num=1, arch=53, device=None):
     print('model:', modelname)
+    device = device or select_device()
     if modelname == 'lawinloss':
-        model = KingMSEG_lawin_loss(class_num=class_num).cuda()
+        model = KingMSEG_lawin_loss(class_num=class_num).to(device)
     elif modelname == 'lawinloss4':
-        model = KingMSEG_lawin_loss4(class_num=class_num).cuda()
+        model = KingMSEG_lawin_loss4(class_num=class_num).to(device)
 
     return model
 